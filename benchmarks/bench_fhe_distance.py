@@ -0,0 +1,183 @@
+# benchmarks/bench_fhe_distance.py
+"""
+Latency per probe of the batched Concrete distance circuit against the Paillier
+per-template loop, for several gallery and chunk sizes.
+
+With --decision the argmin and threshold decision circuits are timed too, on
+reduced vectors (--decision-dims values in 0..--decision-max-value), next to the
+distance circuit on the same vectors. The server folds the chunk results into one,
+so their response is one or two ciphertexts per probe instead of one distance per
+template; response_bytes and decrypt_s show what that saves the client.
+
+    python -m benchmarks.bench_fhe_distance --gallery-sizes 16,64,256 --chunk-sizes 16,64
+"""
+import argparse
+import json
+import time
+import numpy as np
+from phe import paillier
+from src.circuit_cache import DEFAULT_CACHE_DIR
+from src.fhe_matching import (
+    get_distance_circuit,
+    encrypt_probe,
+    encrypt_gallery,
+    fhe_gallery_distances,
+    decrypt_gallery_distances,
+    decision_layout,
+    get_decision_circuit,
+    encrypt_decision_probe,
+    prepare_decision_gallery,
+    fhe_gallery_decisions,
+    decrypt_best_match,
+    decrypt_match,
+)
+from src.secure_computation import (
+    encrypt_vector,
+    compute_encrypted_squared_distance,
+    mask_encrypted_distances,
+    decrypt_and_unmask_distances,
+)
+
+
+def bench_fhe(probe, gallery, chunk_size, encrypted_gallery, cache_dir):
+    """Time one probe against the gallery with the Concrete circuit."""
+    start = time.perf_counter()
+    circuit = get_distance_circuit(chunk_size, probe.shape[0], encrypted_gallery=encrypted_gallery, cache_dir=cache_dir)
+    load_time = time.perf_counter() - start
+    gallery_chunks = encrypt_gallery(circuit, gallery, chunk_size)
+
+    start = time.perf_counter()
+    encrypted_probe = encrypt_probe(circuit, probe)
+    encrypt_time = time.perf_counter() - start
+    start = time.perf_counter()
+    results = fhe_gallery_distances(circuit, encrypted_probe, gallery_chunks)
+    run_time = time.perf_counter() - start
+    start = time.perf_counter()
+    distances = decrypt_gallery_distances(circuit, results, len(gallery))
+    decrypt_time = time.perf_counter() - start
+    return {
+        "circuit_load_s": load_time,
+        "encrypt_s": encrypt_time,
+        "run_s": run_time,
+        "decrypt_s": decrypt_time,
+        "latency_s": encrypt_time + run_time + decrypt_time,
+        "response_bytes": sum(len(result.serialize()) for result in results),
+    }, distances
+
+
+def bench_decision(probe, gallery, layout, threshold, cache_dir):
+    """Time one probe against the gallery with a decision module. Returns the timings and the decision."""
+    start = time.perf_counter()
+    circuit = get_decision_circuit(layout, cache_dir=cache_dir)
+    load_time = time.perf_counter() - start
+    gallery_chunks = prepare_decision_gallery(circuit, gallery, layout, threshold)
+
+    start = time.perf_counter()
+    encrypted_probe = encrypt_decision_probe(circuit, probe)
+    encrypt_time = time.perf_counter() - start
+    start = time.perf_counter()
+    result = fhe_gallery_decisions(circuit, encrypted_probe, gallery_chunks)
+    run_time = time.perf_counter() - start
+    start = time.perf_counter()
+    if layout.mode == "argmin":
+        decision = decrypt_best_match(circuit, result, layout)
+    else:
+        decision = decrypt_match(circuit, result)
+    decrypt_time = time.perf_counter() - start
+    return {
+        "circuit_load_s": load_time,
+        "encrypt_s": encrypt_time,
+        "run_s": run_time,
+        "decrypt_s": decrypt_time,
+        "latency_s": encrypt_time + run_time + decrypt_time,
+        "response_bytes": sum(len(value.serialize()) for value in (result if isinstance(result, tuple) else (result,))),
+    }, decision
+
+
+def bench_paillier(probe, gallery, public_key, private_key):
+    """Time one probe against the gallery with the Paillier per-template loop."""
+    start = time.perf_counter()
+    encrypted_probe = encrypt_vector(probe, public_key)
+    encrypt_time = time.perf_counter() - start
+    start = time.perf_counter()
+    encrypted_distances = [compute_encrypted_squared_distance(encrypted_probe, template, public_key) for template in gallery]
+    masked = mask_encrypted_distances(encrypted_distances, public_key)
+    run_time = time.perf_counter() - start
+    start = time.perf_counter()
+    distances = decrypt_and_unmask_distances(masked, private_key)
+    decrypt_time = time.perf_counter() - start
+    return {
+        "encrypt_s": encrypt_time,
+        "run_s": run_time,
+        "decrypt_s": decrypt_time,
+        "latency_s": encrypt_time + run_time + decrypt_time,
+    }, np.array(distances)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gallery-sizes", default="16,64,256", help="comma-separated gallery sizes")
+    parser.add_argument("--chunk-sizes", default="16,64", help="comma-separated circuit chunk sizes")
+    parser.add_argument("--dims", type=int, default=640)
+    parser.add_argument("--key-size", type=int, default=2048, help="Paillier modulus size in bits")
+    parser.add_argument("--encrypted-gallery", action="store_true",
+                        help="also encrypt the gallery (one bootstrap per element, very slow at 7 bits)")
+    parser.add_argument("--decision", action="store_true", help="also time the argmin and threshold decision circuits")
+    parser.add_argument("--decision-chunk-size", type=int, default=8, help="templates per decision circuit")
+    parser.add_argument("--decision-dims", type=int, default=32, help="length of the reduced vectors")
+    parser.add_argument("--decision-max-value", type=int, default=3, help="largest value of the reduced vectors")
+    parser.add_argument("--skip-paillier", action="store_true")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    gallery_sizes = [int(size) for size in args.gallery_sizes.split(",")]
+    chunk_sizes = [int(size) for size in args.chunk_sizes.split(",")]
+    probe = rng.integers(0, 128, size=args.dims)
+    full_gallery = rng.integers(0, 128, size=(max(gallery_sizes), args.dims))
+    if args.decision:
+        decision_probe = rng.integers(0, args.decision_max_value + 1, size=args.decision_dims)
+        decision_gallery = rng.integers(0, args.decision_max_value + 1, size=(max(gallery_sizes), args.decision_dims))
+    if not args.skip_paillier:
+        public_key, private_key = paillier.generate_paillier_keypair(n_length=args.key_size)
+
+    report = []
+    for gallery_size in gallery_sizes:
+        gallery = full_gallery[:gallery_size]
+        expected = np.sum(gallery * gallery, axis=1) - 2 * gallery @ probe
+        if args.encrypted_gallery:
+            expected = expected + probe @ probe
+        entry = {"gallery_size": gallery_size, "fhe": {}}
+        for chunk_size in chunk_sizes:
+            timings, distances = bench_fhe(probe, gallery, chunk_size, args.encrypted_gallery, args.cache_dir)
+            timings["correct"] = bool(np.array_equal(distances, expected))
+            entry["fhe"][chunk_size] = timings
+        if args.decision:
+            reduced = decision_gallery[:gallery_size]
+            true_distances = np.sum((reduced - decision_probe) ** 2, axis=1)
+            timings, distances = bench_fhe(decision_probe, reduced, args.decision_chunk_size, False, args.cache_dir)
+            timings["correct"] = bool(np.array_equal(distances + decision_probe @ decision_probe, true_distances))
+            entry["decision_distances"] = timings
+            layout = decision_layout("argmin", args.decision_chunk_size, args.decision_dims, args.decision_max_value)
+            timings, (row, distance) = bench_decision(decision_probe, reduced, layout, None, args.cache_dir)
+            # Ties may resolve to another row at the same distance (see decrypt_best_match)
+            timings["correct"] = bool(true_distances[row] == distance == true_distances.min())
+            entry["argmin"] = timings
+            threshold = int(np.median(true_distances))
+            layout = decision_layout("threshold", args.decision_chunk_size, args.decision_dims, args.decision_max_value)
+            timings, match = bench_decision(decision_probe, reduced, layout, threshold, args.cache_dir)
+            timings["correct"] = match == bool(true_distances.min() < threshold)
+            entry["threshold"] = timings
+        if not args.skip_paillier:
+            timings, distances = bench_paillier(probe, gallery, public_key, private_key)
+            timings["correct"] = bool(np.array_equal(distances, np.sum(gallery * gallery, axis=1) - 2 * gallery @ probe))
+            entry["paillier"] = timings
+        report.append(entry)
+        print(json.dumps(entry), flush=True)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# benchmarks/bench_paillier_distance.py
+"""
+Before/after benchmark of the Paillier squared-distance kernel.
+
+Compares the element-by-element reference (one encryption per element) with
+compute_encrypted_squared_distance, with the precomputed GalleryEncoding and with
+the packed kernel on random 7-bit templates, and checks that all of them decrypt
+to the same distances.
+
+    python -m benchmarks.bench_paillier_distance --templates 5 --dims 640
+"""
+import argparse
+import json
+import time
+import numpy as np
+from phe import paillier
+from src.secure_computation import (
+    encrypt_vector,
+    compute_encrypted_squared_distance,
+    _compute_encrypted_squared_distance_loop,
+    packed_layout,
+    encrypt_vector_packed,
+    compute_encrypted_squared_distance_packed,
+    mask_encrypted_distances_packed,
+    decrypt_and_unmask_distances_packed,
+    GalleryEncoding,
+)
+
+
+def time_kernel(kernel, encrypted_probe, gallery, public_key, *args):
+    """Run a distance kernel over the gallery and return (seconds per template, distances)."""
+    start = time.perf_counter()
+    distances = [kernel(encrypted_probe, template, public_key, *args) for template in gallery]
+    return (time.perf_counter() - start) / len(gallery), distances
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--templates", type=int, default=5, help="gallery templates to compare against")
+    parser.add_argument("--dims", type=int, default=640, help="feature vector length")
+    parser.add_argument("--key-size", type=int, default=2048, help="Paillier modulus size in bits")
+    parser.add_argument("--blinding-bits", type=int, default=40, help="random padding per packed slot")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    public_key, private_key = paillier.generate_paillier_keypair(n_length=args.key_size)
+    probe = rng.integers(0, 128, size=args.dims)
+    gallery = rng.integers(0, 128, size=(args.templates, args.dims))
+    start = time.perf_counter()
+    encrypted_probe = encrypt_vector(probe, public_key)
+    encrypt_time = time.perf_counter() - start
+
+    layout = packed_layout(public_key, dims=args.dims, blinding_bits=args.blinding_bits)
+    start = time.perf_counter()
+    packed_probe = encrypt_vector_packed(probe, public_key, layout)
+    packed_encrypt_time = time.perf_counter() - start
+
+    before, reference = time_kernel(_compute_encrypted_squared_distance_loop, encrypted_probe, gallery, public_key)
+    after, optimized = time_kernel(compute_encrypted_squared_distance, encrypted_probe, gallery, public_key)
+    start = time.perf_counter()
+    encoding = GalleryEncoding.from_vectors(range(len(gallery)), gallery)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    encoded = encoding.encrypted_distances(encrypted_probe, public_key)
+    encoded_time = (time.perf_counter() - start) / len(gallery)
+    packed_time, packed = time_kernel(compute_encrypted_squared_distance_packed, packed_probe, gallery, public_key, layout)
+
+    reference = [private_key.decrypt(d) for d in reference]
+    optimized = [private_key.decrypt(d) for d in optimized]
+    encoded = [private_key.decrypt(d) for d in encoded]
+    packed = decrypt_and_unmask_distances_packed(
+        mask_encrypted_distances_packed(packed, public_key, layout), private_key, layout, probe)
+    expected = [int(t @ t - 2 * probe @ t) for t in gallery]
+
+    print(json.dumps({
+        "templates": args.templates,
+        "dims": args.dims,
+        "key_size": args.key_size,
+        "reference_s_per_template": before,
+        "optimized_s_per_template": after,
+        "speedup": before / after,
+        "identical": reference == optimized == expected,
+        "encoded": {
+            "s_per_template": encoded_time,
+            "speedup": after / encoded_time,
+            "encode_s_per_template": encode_time / len(gallery),
+            "bytes_per_template": encoding.nbytes / len(gallery),
+            "identical": encoded == expected,
+        },
+        "probe_ciphertexts": len(encrypted_probe),
+        "probe_encrypt_s": encrypt_time,
+        "packed": {
+            "slots": layout.slots,
+            "slot_bits": layout.slot_bits,
+            "probe_ciphertexts": len(packed_probe),
+            "probe_encrypt_s": packed_encrypt_time,
+            "s_per_template": packed_time,
+            "identical": packed == expected,
+        },
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
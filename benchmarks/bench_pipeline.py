@@ -0,0 +1,326 @@
+# benchmarks/bench_pipeline.py
+"""
+Headless speed and accuracy benchmark of the whole pipeline on FVC2000_DB4_B.
+
+Times every stage per image (p50/p99 latency, throughput) and for batches:
+image load, load + preprocess, FingerCode extraction (single and batched),
+quantization, Concrete encrypt/serialize, Paillier probe encryption, distance
+and decryption, and database insert/scan. Peak RSS is recorded after each
+stage. On the same features it computes the EER and the leave-one-out rank-1
+accuracy (subject = filename prefix before "_"), so a speedup that breaks
+matching shows up in the same report.
+
+With --pack-dir the images are read from a pack written by src.dataset
+(python -m src.dataset) instead of being decoded from BMP files.
+
+The bit-width sweep fits a Quantizer (src.quantization) for every width of
+--bit-widths on the same features and reports its EER and rank-1 accuracy,
+next to the latency of the Concrete distance circuit compiled for that range
+(one probe against --fhe-chunk-size clear templates). The dimension sweep does
+the same for a DimensionReducer (src.reduction) fitted to every size of
+--reduce-dims, and also times the Paillier encryption of a reduced probe.
+
+    python -m benchmarks.bench_pipeline --limit 800 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+import cv2
+import numpy as np
+from phe import paillier
+from src.dataset import load_pack
+from src.preprocessing import (
+    load_and_preprocess_image,
+    preprocess_image,
+    ImagePreprocessor,
+    extract_fingercode_features,
+    extract_fingercode_features_batch,
+)
+from src.database import quantize_features, encrypt_features, get_encryption_circuit, FingerprintStore
+from src.fhe_matching import get_distance_circuit, encrypt_probe, encrypt_gallery, fhe_gallery_distances
+from src.gallery import GalleryReader
+from src.index import QuantizedIndex
+from src.quantization import Quantizer
+from src.reduction import DimensionReducer, METHODS
+from src.secure_computation import (
+    encrypt_vector,
+    compute_encrypted_squared_distance,
+    mask_encrypted_distances,
+    decrypt_and_unmask_distances,
+)
+
+DEFAULT_DATASET = "data/dataset_FVC2000_DB4_B/dataset/train_data"
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MiB (ru_maxrss is in KiB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def summarize(latencies, items=None):
+    """Summarize per-call latencies in seconds; items is the number of images they covered."""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total = float(latencies.sum())
+    items = len(latencies) if items is None else items
+    return {
+        "calls": len(latencies),
+        "items": items,
+        "total_s": total,
+        "throughput_per_s": items / total if total else None,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def timed(function, *args):
+    """Call function(*args) and return (result, seconds)."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def equal_error_rate(distances, subjects):
+    """
+    EER of a squared-distance matrix, using every unordered pair of distinct samples.
+    Returns (eer, threshold) where threshold is the distance at which FAR and FRR cross.
+    """
+    upper = np.triu_indices(len(subjects), k=1)
+    pair_distances = distances[upper]
+    genuine = subjects[upper[0]] == subjects[upper[1]]
+    order = np.argsort(pair_distances, kind="stable")
+    genuine = genuine[order]
+    # Accepting every pair up to position i: FRR counts genuine pairs beyond it, FAR impostors within it
+    accepted_genuine = np.cumsum(genuine)
+    accepted_impostor = np.cumsum(~genuine)
+    frr = 1 - accepted_genuine / genuine.sum()
+    far = accepted_impostor / (~genuine).sum()
+    crossing = int(np.argmin(np.abs(far - frr)))
+    return float((far[crossing] + frr[crossing]) / 2), int(pair_distances[order][crossing])
+
+
+def rank1_accuracy(distances, subjects):
+    """Leave-one-out rank-1 identification accuracy of a squared-distance matrix."""
+    distances = distances.astype(np.float64)
+    np.fill_diagonal(distances, np.inf)
+    return float(np.mean(subjects[np.argmin(distances, axis=1)] == subjects))
+
+
+def distance_accuracy(names, quantized, subjects, max_value=127):
+    """EER, its threshold and rank-1 accuracy of quantized vectors, from their exact distance matrix."""
+    index = QuantizedIndex(dims=quantized.shape[1], max_value=max_value, capacity=max(1, len(names)))
+    index.add_many(names, quantized)
+    distances = index.distances(quantized)
+    eer, threshold = equal_error_rate(distances, subjects)
+    return {"eer": eer, "eer_threshold": threshold, "rank1": rank1_accuracy(distances, subjects)}
+
+
+def fhe_distance_latency(quantized, max_value, chunk_size, runs=3):
+    """Load time of the distance circuit for quantized vectors, and latency of one probe against chunk_size of them."""
+    circuit, load_s = timed(get_distance_circuit, chunk_size, quantized.shape[1], max_value)
+    chunks = encrypt_gallery(circuit, quantized[:chunk_size], chunk_size)
+    encrypted_probe = encrypt_probe(circuit, quantized[0])
+    latencies = [timed(fhe_gallery_distances, circuit, encrypted_probe, chunks)[1] for _ in range(runs)]
+    return {"fhe_circuit_load_s": load_s, "fhe_distance": summarize(latencies, items=runs * chunk_size)}
+
+
+def bit_width_sweep(names, features, subjects, bit_widths, per_dimension, fhe_chunk_size, skip_fhe=False):
+    """Accuracy and FHE distance latency of a fitted Quantizer for every bit width."""
+    sweep = {}
+    for bits in bit_widths:
+        quantizer, fit_s = timed(Quantizer.fit, features, bits, per_dimension)
+        quantized, quantize_s = timed(quantizer.quantize, features)
+        result = {"max_value": quantizer.max_value, "fit_s": fit_s, "quantize_batch_s": quantize_s}
+        result.update(distance_accuracy(names, quantized, subjects, quantizer.max_value))
+        if not skip_fhe:
+            result.update(fhe_distance_latency(quantized, quantizer.max_value, fhe_chunk_size))
+        sweep[str(bits)] = result
+    return sweep
+
+
+def dimension_sweep(names, features, subjects, dims_list, method, bits, fhe_chunk_size, skip_fhe=False, public_key=None):
+    """Accuracy and encrypted-stage latency of a fitted DimensionReducer for every output size."""
+    sweep = {}
+    for dims in dims_list:
+        reducer, fit_s = timed(DimensionReducer.fit, features, dims, method, subjects)
+        reduced, transform_s = timed(reducer.transform, features)
+        quantizer = Quantizer.fit(reduced, bits, per_dimension=False, low_percentile=0, high_percentile=100)
+        quantized = quantizer.quantize(reduced)
+        result = {"version": reducer.version, "fit_s": fit_s, "transform_batch_s": transform_s}
+        result.update(distance_accuracy(names, quantized, subjects, quantizer.max_value))
+        if not skip_fhe:
+            result.update(fhe_distance_latency(quantized, quantizer.max_value, fhe_chunk_size))
+        if public_key is not None:
+            result["paillier_encrypt_probe_s"] = timed(encrypt_vector, quantized[0], public_key)[1]
+        sweep[str(dims)] = result
+    return sweep
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="directory of fingerprint images")
+    parser.add_argument("--pack-dir", help="read images from a src.dataset pack in this directory")
+    parser.add_argument("--pack-name", default="train", help="name of the pack in --pack-dir")
+    parser.add_argument("--limit", type=int, default=800, help="number of images to use")
+    parser.add_argument("--batch-size", type=int, default=32, help="images per batched extraction call")
+    parser.add_argument("--preprocess-workers", type=int, default=1, help="threads of the batched preprocessor")
+    parser.add_argument("--fhe-samples", type=int, default=20, help="templates to encrypt with Concrete and store")
+    parser.add_argument("--paillier-templates", type=int, default=5, help="gallery templates for the Paillier stages")
+    parser.add_argument("--key-size", type=int, default=2048, help="Paillier modulus size in bits")
+    parser.add_argument("--bit-widths", default="7,6,5,4,3", help="comma-separated quantizer widths to sweep")
+    parser.add_argument("--global-range", action="store_true", help="fit one quantizer range for all dimensions")
+    parser.add_argument("--fhe-chunk-size", type=int, default=16, help="templates per distance circuit in the sweeps")
+    parser.add_argument("--reduce-dims", default="64,128,256", help="comma-separated reducer sizes to sweep")
+    parser.add_argument("--reduce-method", choices=METHODS, default="pca", help="reducer fitted in the dimension sweep")
+    parser.add_argument("--reduce-bits", type=int, default=7, help="quantizer width in the dimension sweep")
+    parser.add_argument("--skip-fhe", action="store_true", help="skip the Concrete and database stages")
+    parser.add_argument("--skip-paillier", action="store_true", help="skip the Paillier stages")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.pack_dir:
+        start = time.perf_counter()
+        pack = load_pack(args.pack_dir, args.pack_name)
+        pack_open_s = time.perf_counter() - start
+        filenames = pack.filenames[:args.limit]
+    else:
+        filenames = sorted(f for f in os.listdir(args.dataset) if f.endswith((".bmp", ".jpg", ".png")))[:args.limit]
+        paths = [os.path.join(args.dataset, filename) for filename in filenames]
+    subjects = np.array([filename.split("_")[0] for filename in filenames])
+    stages = {}
+
+    # The pipeline functions print progress for every image; keep stdout for the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        images, latencies = [], []
+        if args.pack_dir:
+            stages["pack_open"] = summarize([pack_open_s], items=1)
+            raw = [pack.images[row] for row in range(len(filenames))]
+            stages["load"] = summarize([timed(np.array, image)[1] for image in raw])
+            for row in range(len(filenames)):
+                image, seconds = timed(preprocess_image, pack.images[row])
+                images.append(image)
+                latencies.append(seconds)
+        else:
+            raw, latencies = [], []
+            for path in paths:
+                image, seconds = timed(cv2.imread, path, cv2.IMREAD_GRAYSCALE)
+                raw.append(image)
+                latencies.append(seconds)
+            stages["load"] = summarize(latencies)
+            latencies = []
+            for path in paths:
+                image, seconds = timed(load_and_preprocess_image, path)
+                images.append(image)
+                latencies.append(seconds)
+        stages["load_and_preprocess"] = summarize(latencies)
+
+        preprocessor = ImagePreprocessor(workers=args.preprocess_workers)
+        buffer = np.empty((args.batch_size, preprocessor.image_size, preprocessor.image_size), dtype=np.uint8)
+        latencies = []
+        for start in range(0, len(raw), args.batch_size):
+            latencies.append(timed(preprocessor.preprocess_batch, raw[start:start + args.batch_size], buffer)[1])
+        stages["preprocess_batch"] = summarize(latencies, items=len(raw))
+        preprocessor.close()
+
+        single = min(len(images), args.batch_size)
+        stages["extract_single"] = summarize([timed(extract_fingercode_features, image)[1] for image in images[:single]])
+
+        features, latencies = [], []
+        for start in range(0, len(images), args.batch_size):
+            batch, seconds = timed(extract_fingercode_features_batch, images[start:start + args.batch_size])
+            features.append(batch)
+            latencies.append(seconds)
+        features = np.concatenate(features)
+        stages["extract_batch"] = summarize(latencies, items=len(images))
+
+        quantized, latencies = [], []
+        for feature_vector in features:
+            vector, seconds = timed(quantize_features, feature_vector)
+            quantized.append(vector)
+            latencies.append(seconds)
+        quantized = np.stack(quantized)
+        stages["quantize"] = summarize(latencies)
+        stages["quantize_batch"] = summarize([timed(quantize_features, features)[1]], items=len(features))
+        bit_widths = [int(bits) for bits in args.bit_widths.split(",") if bits]
+        sweep = bit_width_sweep(filenames, features, subjects, bit_widths, not args.global_range,
+                                args.fhe_chunk_size, skip_fhe=args.skip_fhe)
+
+        if not args.skip_fhe:
+            circuit, seconds = timed(get_encryption_circuit)
+            stages["concrete_circuit_load"] = summarize([seconds], items=1)
+            samples = quantized[:args.fhe_samples]
+            encrypted = []
+            latencies = []
+            for vector in samples:
+                blob, seconds = timed(encrypt_features, vector, circuit)
+                encrypted.append(blob)
+                latencies.append(seconds)
+            stages["concrete_encrypt_serialize"] = summarize(latencies)
+
+            with tempfile.TemporaryDirectory() as tmp:
+                with FingerprintStore(os.path.join(tmp, "bench.db")) as store:
+                    rows = [(filename, blob) for filename, blob in zip(filenames, encrypted)]
+                    stages["db_insert_single"] = summarize([timed(store.insert, *row)[1] for row in rows])
+                    _, seconds = timed(store.insert_many, rows)
+                    stages["db_insert_batch"] = summarize([seconds], items=len(rows))
+                    reader = GalleryReader(circuit, store=store)
+                    _, cold = timed(lambda: sum(1 for _ in reader))
+                    _, warm = timed(lambda: sum(1 for _ in reader))
+                    stages["db_scan_cold"] = summarize([cold], items=len(rows))
+                    stages["db_scan_warm"] = summarize([warm], items=len(rows))
+                    reader.close()
+
+        if not args.skip_paillier:
+            (public_key, private_key), seconds = timed(paillier.generate_paillier_keypair, None, args.key_size)
+            stages["paillier_keygen"] = summarize([seconds], items=1)
+            probe = quantized[0]
+            gallery = quantized[1:1 + args.paillier_templates]
+            encrypted_probe, seconds = timed(encrypt_vector, probe, public_key)
+            stages["paillier_encrypt_probe"] = summarize([seconds], items=1)
+            distances, latencies = [], []
+            for template in gallery:
+                distance, seconds = timed(compute_encrypted_squared_distance, encrypted_probe, template, public_key)
+                distances.append(distance)
+                latencies.append(seconds)
+            stages["paillier_distance"] = summarize(latencies)
+            masked, seconds = timed(mask_encrypted_distances, distances, public_key)
+            stages["paillier_mask"] = summarize([seconds], items=len(distances))
+            decrypted, seconds = timed(decrypt_and_unmask_distances, masked, private_key)
+            stages["paillier_decrypt"] = summarize([seconds], items=len(decrypted))
+            probe64 = probe.astype(np.int64)
+            expected = [int(t.astype(np.int64) @ t - 2 * probe64 @ t) for t in gallery]
+            paillier_exact = [int(d) for d in decrypted] == expected
+
+        dims_list = [int(dims) for dims in args.reduce_dims.split(",") if dims]
+        reduction_sweep = dimension_sweep(filenames, features, subjects, dims_list, args.reduce_method,
+                                          args.reduce_bits, args.fhe_chunk_size, skip_fhe=args.skip_fhe,
+                                          public_key=None if args.skip_paillier else public_key)
+
+    report = {
+        "dataset": os.path.join(args.pack_dir, args.pack_name) if args.pack_dir else args.dataset,
+        "images": len(filenames),
+        "subjects": int(len(np.unique(subjects))),
+        "batch_size": args.batch_size,
+        "stages": stages,
+        "accuracy": distance_accuracy(filenames, quantized, subjects),
+        "quantizer_range": "global" if args.global_range else "per-dimension",
+        "bit_width_sweep": sweep,
+        "reduce_method": args.reduce_method,
+        "dimension_sweep": reduction_sweep,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if not args.skip_paillier:
+        report["accuracy"]["paillier_exact"] = paillier_exact
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
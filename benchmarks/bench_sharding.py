@@ -0,0 +1,103 @@
+# benchmarks/bench_sharding.py
+"""
+Benchmark of the sharded gallery (src.sharding).
+
+Enrolls random quantized templates into 1, 2, ... shards, then times one Paillier
+secure search (scatter the encrypted probe, gather the masked distances, decrypt
+on the client) and a batch of plaintext searches, and checks both against a
+plaintext QuantizedIndex. Finally a shard is added and the number of templates
+moved by the rebalance is compared with the 1/(N+1) rendezvous hashing expects.
+Workers are local processes, so the speedup is bounded by the cores of the machine.
+
+    python -m benchmarks.bench_sharding --templates 64 --shards 1,2,4
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from phe import paillier
+from src.database import get_encryption_circuit
+from src.index import QuantizedIndex
+from src.secure_computation import encrypt_vector, decrypt_and_unmask_distances_batch
+from src.sharding import ShardedGallery
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--templates", type=int, default=64, help="gallery templates")
+    parser.add_argument("--dims", type=int, default=640, help="feature vector length")
+    parser.add_argument("--max-value", type=int, default=127, help="largest quantized value")
+    parser.add_argument("--shards", default="1,2,4", help="comma-separated shard counts")
+    parser.add_argument("--probes", type=int, default=32, help="probes of the plaintext search batch")
+    parser.add_argument("--key-size", type=int, default=2048, help="Paillier modulus size in bits")
+    parser.add_argument("--cache-dir", default="data/circuit_cache")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    labels = [f"{i:05d}_1" for i in range(args.templates)]
+    gallery = rng.integers(0, args.max_value + 1, size=(args.templates, args.dims)).astype(np.uint8)
+    probes = rng.integers(0, args.max_value + 1, size=(args.probes, args.dims)).astype(np.uint8)
+    circuit = get_encryption_circuit(args.cache_dir, max_value=args.max_value, dims=args.dims)
+    rows = [(label, circuit.encrypt(vector).serialize()) for label, vector in zip(labels, gallery)]
+
+    exact = QuantizedIndex(dims=args.dims, max_value=args.max_value, capacity=args.templates)
+    exact.add_many(labels, gallery)
+    expected = exact.search_batch(probes, 5)
+    # The encrypted distance leaves out ||x||^2, which does not change the ranking
+    probe_norm = int(probes[0].astype(np.int64) @ probes[0])
+    expected_distances = dict(zip(labels, (exact.distances(probes[:1])[0] - probe_norm).tolist()))
+    public_key, private_key = paillier.generate_paillier_keypair(n_length=args.key_size)
+    start = time.perf_counter()
+    encrypted_probe = encrypt_vector(probes[0], public_key)
+    encrypt_time = time.perf_counter() - start
+
+    report = {"templates": args.templates, "dims": args.dims, "key_size": args.key_size,
+              "probe_encrypt_s": encrypt_time, "cpu_count": os.cpu_count(), "shards": {}}
+    for shard_count in [int(count) for count in args.shards.split(",") if count]:
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            sharded = ShardedGallery(os.path.join(tmp, "gallery.db"), shard_count, circuit, args.dims, args.max_value)
+            try:
+                sharded.insert_many(rows)
+                insert_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                shard_labels, masked = sharded.secure_distance_computation(encrypted_probe, public_key)
+                search_time = time.perf_counter() - start
+                distances = decrypt_and_unmask_distances_batch(masked, private_key)
+                secure_exact = dict(zip(shard_labels, distances.tolist())) == expected_distances
+
+                start = time.perf_counter()
+                matches = sharded.search_batch(probes, 5)
+                plain_time = time.perf_counter() - start
+
+                sizes = sharded.sizes()
+                start = time.perf_counter()
+                moved = sharded.add_shard()
+                rebalance_time = time.perf_counter() - start
+                after = sharded.search_batch(probes, 5)
+            finally:
+                sharded.close()
+        entry = {
+            "sizes": sizes,
+            "start_and_insert_s": insert_time,
+            "secure_search_s": search_time,
+            "secure_exact": secure_exact,
+            "plain_search_s_per_probe": plain_time / len(probes),
+            "plain_exact": matches == expected,
+            "rebalance_moved": moved,
+            "rebalance_expected": args.templates / (shard_count + 1),
+            "rebalance_s": rebalance_time,
+            "exact_after_rebalance": after == expected,
+        }
+        report["shards"][shard_count] = entry
+        print(json.dumps({shard_count: entry}), flush=True)
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# benchmarks/load_test.py
+"""
+Load-test client for the verification service (src.service).
+
+Runs a closed loop of concurrent clients at several concurrency levels, each
+client on its own keep-alive connection, and reports throughput against
+p50/p99 latency and the number of 503 (admission control) answers as JSON.
+Probes are the images of --probes, sent as files or as extracted features.
+
+    python -m src.service --gallery data/dataset_FVC2000_DB4_B/dataset/train_data &
+    python -m benchmarks.load_test --concurrency 1 4 16 64 --duration 10
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+import numpy as np
+
+
+async def post(reader, writer, path, body):
+    """Send one request on a keep-alive connection and return (status, parsed body)."""
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(host, port, bodies, deadline, latencies, statuses, offset):
+    """Send requests back to back until the deadline."""
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = offset
+    try:
+        while time.perf_counter() < deadline:
+            body = bodies[sent % len(bodies)]
+            start = time.perf_counter()
+            status, _ = await post(reader, writer, "/identify", body)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            sent += 1
+    finally:
+        writer.close()
+
+
+async def run_level(host, port, bodies, concurrency, duration):
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(host, port, bodies, deadline, latencies, statuses, offset) for offset in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "concurrency": concurrency,
+        "requests": sum(statuses.values()),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "throughput_per_s": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+        "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }
+
+
+def load_bodies(probe_dir, limit, mode):
+    """Build the request bodies from the images of a directory."""
+    filenames = sorted(f for f in os.listdir(probe_dir) if f.endswith((".bmp", ".jpg", ".png")))[:limit]
+    bodies = []
+    if mode == "features":
+        from src.preprocessing import load_and_preprocess_image, extract_fingercode_features_batch
+        images = [load_and_preprocess_image(os.path.join(probe_dir, f)) for f in filenames]
+        for features in extract_fingercode_features_batch(images):
+            bodies.append(json.dumps({"features": features.tolist()}).encode())
+    else:
+        for filename in filenames:
+            with open(os.path.join(probe_dir, filename), "rb") as f:
+                bodies.append(json.dumps({"image": base64.b64encode(f.read()).decode()}).encode())
+    return bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--probes", default="data/dataset_FVC2000_DB4_B/dataset/real_data", help="directory of probe images")
+    parser.add_argument("--limit", type=int, default=100, help="number of probe images")
+    parser.add_argument("--mode", choices=("image", "features"), default="image", help="what the requests carry")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per concurrency level")
+    args = parser.parse_args()
+
+    bodies = load_bodies(args.probes, args.limit, args.mode)
+    for concurrency in args.concurrency:
+        result = asyncio.run(run_level(args.host, args.port, bodies, concurrency, args.duration))
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
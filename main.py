@@ -1,11 +1,14 @@
 # main.py
 
 import os
+import logging
 import numpy as np
 from src.database import create_and_populate_database, view_encrypted_data , get_encryption_circuit
 # from src.secure_computation import generate_paillier_keypair, secure_distance_computation, decrypt_and_unmask_distances
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # Directory containing fingerprint images
     fingerprint_dir = "data/fingerprints"
     
@@ -95,4 +98,4 @@ if __name__ == "__main__":
 
 
 
-    
\ No newline at end of file
+    
\ No newline at end of file
@@ -0,0 +1,183 @@
+# src/circuit_cache.py
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from concrete import fhe
+from .metrics import logger
+
+# Bump when the on-disk layout of a cache entry or the way its key is computed changes
+CACHE_FORMAT_VERSION = 2
+DEFAULT_CACHE_DIR = "data/circuit_cache"
+
+
+class CachedCircuit:
+    """
+    Compiled Concrete circuit made of a server, a client and its keys.
+    It offers the fhe.Circuit calls used in this project, so it can be used wherever a
+    freshly compiled circuit was, but it can be loaded back from the cache in milliseconds.
+    A cached module (load_or_compile_module) takes the function_name of every call.
+    """
+
+    def __init__(self, server, client, path=None):
+        self.server = server
+        self.client = client
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        """Load the server, client specs and keys of a cache entry."""
+        server = fhe.Server.load(os.path.join(path, "server.zip"))
+        with open(os.path.join(path, "client.specs"), "rb") as specs_file:
+            client = fhe.Client(fhe.ClientSpecs.deserialize(specs_file.read()))
+        client.keys.load(os.path.join(path, "keys.bin"))
+        return cls(server, client, path)
+
+    @property
+    def keys(self):
+        return self.client.keys
+
+    def keygen(self, force=False):
+        """Generate keys if none are loaded (cached circuits always have theirs)."""
+        self.client.keygen(force)
+
+    def encrypt(self, *args, function_name=None):
+        return self.client.encrypt(*args, function_name=function_name)
+
+    def run(self, *args, function_name=None):
+        return self.server.run(*args, evaluation_keys=self.client.evaluation_keys, function_name=function_name)
+
+    def decrypt(self, *results, function_name=None):
+        return self.client.decrypt(*results, function_name=function_name)
+
+    def encrypt_run_decrypt(self, *args):
+        return self.decrypt(self.run(self.encrypt(*args)))
+
+    def deserialize(self, serialized_value):
+        """Deserialize a value produced by Value.serialize()."""
+        return fhe.Value.deserialize(bytes(serialized_value))
+
+
+def _code_names(code):
+    """Yield the global names used by a code object and the code objects nested in it."""
+    yield from code.co_names
+    for constant in code.co_consts:
+        if inspect.iscode(constant):
+            yield from _code_names(constant)
+
+
+def _hash_value(digest, value, seen):
+    """
+    Hash a value a traced function depends on: functions by source, arrays by content and
+    plain data (numbers, strings, containers, namedtuples) by repr. Modules, classes and other
+    objects are left out, their repr is not stable across processes.
+    """
+    if inspect.isfunction(value):
+        _hash_function(digest, value, seen)
+    elif isinstance(value, np.ndarray):
+        digest.update(f"{value.dtype}{value.shape}".encode())
+        digest.update(value.tobytes())
+    elif isinstance(value, (bool, int, float, complex, str, bytes, tuple, list, dict, frozenset, type(None))):
+        digest.update(repr(value).encode())
+
+
+def _hash_function(digest, function, seen):
+    """
+    Hash the source of a function, its closure values and, recursively, the helper functions
+    and constants it references, so editing a helper invalidates the circuits built on it.
+    """
+    if function in seen:
+        return
+    seen.add(function)
+    try:
+        digest.update(inspect.getsource(function).encode())
+    except (OSError, TypeError):
+        digest.update(f"{function.__module__}.{function.__qualname__}".encode())
+    for cell in function.__closure__ or ():
+        _hash_value(digest, cell.cell_contents, seen)
+    for name in sorted(set(_code_names(function.__code__))):
+        if name in function.__globals__:
+            _hash_value(digest, function.__globals__[name], seen)
+
+
+def circuit_cache_key(function, parameters, inputset, configuration=None):
+    """
+    Hash everything a compiled circuit depends on: the function's source with its closure
+    values and the helpers it references, the encryption status of its parameters, the
+    input-set, the configuration and the Concrete version.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"format={CACHE_FORMAT_VERSION};concrete={fhe.__version__}".encode())
+    _hash_function(digest, function, set())
+    digest.update(json.dumps(parameters, sort_keys=True).encode())
+    digest.update(json.dumps(configuration or {}, sort_keys=True, default=str).encode())
+    for sample in inputset:
+        for value in (sample if isinstance(sample, tuple) else (sample,)):
+            value = np.asarray(value)
+            digest.update(f"{value.dtype}{value.shape}".encode())
+            digest.update(value.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def load_or_compile_circuit(function, parameters, inputset, name, configuration=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Load a compiled circuit and its keys from the cache, compiling and saving it on a miss.
+    The entry is written to a temporary directory and renamed into place, so concurrent
+    processes end up sharing whichever entry lands first, and therefore the same keys.
+    configuration is a dict of fhe.Configuration arguments.
+    """
+    path = os.path.join(cache_dir, f"{name}-{circuit_cache_key(function, parameters, inputset, configuration)}")
+    if os.path.isdir(path):
+        return CachedCircuit.load(path)
+
+    compiler = fhe.Compiler(function, parameters)
+    circuit = compiler.compile(inputset, fhe.Configuration(**(configuration or {})))
+    return _save_entry(circuit, path, name, cache_dir)
+
+
+def load_or_compile_module(functions, inputsets, wires, name, configuration=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Load a compiled Concrete module and its keys from the cache, compiling and saving it on a miss.
+    functions is a list of (function, parameters); every function is called by its __name__,
+    and inputsets maps those names to their input-sets. wires lists the (output function,
+    output position, input function, input position) connections along which results of one
+    call may be fed to another under encryption, so they share keys and parameters.
+    """
+    digest = hashlib.sha256(json.dumps(sorted(wires)).encode())
+    for function, parameters in functions:
+        digest.update(circuit_cache_key(function, parameters, inputsets[function.__name__], configuration).encode())
+    path = os.path.join(cache_dir, f"{name}-{digest.hexdigest()[:16]}")
+    if os.path.isdir(path):
+        return CachedCircuit.load(path)
+
+    members = {function.__name__: fhe.function(parameters)(function) for function, parameters in functions}
+    members["composition"] = fhe.Wired({
+        fhe.Wire(fhe.Output(members[source], output), fhe.Input(members[target], position))
+        for source, output, target, position in wires
+    })
+    module = fhe.module()(type("Module", (), members))
+    compiled = module.compile(inputsets, fhe.Configuration(**(configuration or {})))
+    return _save_entry(compiled, path, name, cache_dir)
+
+
+def _save_entry(circuit, path, name, cache_dir):
+    """Generate the keys of a compiled circuit or module, save it as a cache entry and load it back."""
+    circuit.keygen()
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f".{name}-", dir=cache_dir)
+    try:
+        circuit.server.save(os.path.join(staging, "server.zip"))
+        with open(os.path.join(staging, "client.specs"), "wb") as specs_file:
+            specs_file.write(circuit.client.specs.serialize())
+        circuit.keys.save(os.path.join(staging, "keys.bin"))
+        os.rename(staging, path)
+    except OSError:
+        # Another process saved the same circuit first; use its keys
+        shutil.rmtree(staging, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    logger.info("Compiled circuit %s and saved it to %s.", name, path)
+    return CachedCircuit.load(path)
@@ -1,37 +1,69 @@
 # src/database.py
-from concrete import fhe
 import sqlite3
+import threading
 import numpy as np
 import os
 from .preprocessing import load_and_preprocess_image, extract_fingercode_features
+from .circuit_cache import DEFAULT_CACHE_DIR, load_or_compile_circuit
+from .metrics import logger, timed, increment
+from .quantization import quantizer_path, load_quantizer
+from .reduction import reducer_path, load_reducer
+from .secure_computation import encode_template
 
-def quantize_features(features, max_value=127):
-    """Scale and convert floating-point features to integers within a safe range."""
-    # Determine dynamic scale factor to fit max_value
-    scale = max_value / np.max(np.abs(features)) if np.max(np.abs(features)) > 0 else 1
-    quantized_features = np.clip(np.round(features * scale), 0, max_value).astype(np.uint7)
-    print(f"Dynamic Scale Factor: {scale}")
+@timed("quantize")
+def quantize_features(features, max_value=127, quantizer=None, reducer=None):
+    """
+    Scale and convert floating-point features to integers within a safe range.
+    With a fitted Quantizer (src.quantization) every vector gets the quantizer's common scale;
+    without one each vector is scaled by its own maximum. Takes one vector or an (N, dims) batch.
+    A DimensionReducer (src.reduction) is applied first and needs a quantizer fitted on its
+    output (Quantizer.fit with per_dimension=False); reduced features are centered, so the
+    per-vector scale would clip every negative component to 0. Without one it raises ValueError.
+    """
+    if reducer is not None:
+        if quantizer is None:
+            raise ValueError("A reducer needs a Quantizer fitted on reduced features (per_dimension=False)")
+        features = reducer.transform(features)
+    if quantizer is not None:
+        return quantizer.quantize(features)
+    features = np.asarray(features)
+    # Dynamic scale factor mapping the largest magnitude of each vector to max_value
+    peak = np.max(np.abs(features), axis=-1, keepdims=True)
+    scale = max_value / np.where(peak > 0, peak, max_value)
+    quantized_features = np.clip(np.round(features * scale), 0, max_value).astype(np.uint8)
+    logger.debug("Dynamic scale factor: %s", scale)
     return quantized_features
 
 
-def encrypt_features(features, circuit):
+def encrypt_features(features, circuit, quantizer=None, reducer=None):
     """Quantize and encrypt the feature vector using the provided Concrete circuit."""
-    quantized_features = quantize_features(features)
-    print(f"Quantized Features (dtype: {quantized_features.dtype}): {quantized_features[:10]}...")
+    quantized_features = quantize_features(features, quantizer=quantizer, reducer=reducer)
+    logger.debug("Quantized features (dtype: %s): %s...", quantized_features.dtype, quantized_features[:10])
+    return encrypt_quantized_features(quantized_features, circuit)
+
+
+@timed("encrypt")
+def encrypt_quantized_features(quantized_features, circuit):
+    """Encrypt an already quantized feature vector using the provided Concrete circuit."""
     encrypted_value = circuit.encrypt(quantized_features)
     encrypted_bytes = encrypted_value.serialize()
-    print("Features encrypted successfully.")
+    increment("templates_encrypted")
+    logger.debug("Features encrypted successfully.")
     return encrypted_bytes
 
 
-def get_encryption_circuit():
+def get_encryption_circuit(cache_dir=DEFAULT_CACHE_DIR, max_value=127, dims=640):
+    """
+    Load the encryption circuit and its keys from the circuit cache, compiling it on first use.
+    max_value is the largest quantized value (Quantizer.max_value); narrower ranges compile
+    to smaller circuits. dims is the length of the encrypted vectors (DimensionReducer.dims).
+    """
     def encrypt_fn(x):
         return x + 1  # Example encryption logic, modify as needed
-    
-    compiler = fhe.Compiler(encrypt_fn, {"x": "encrypted"})
-    inputset = [(np.random.randint(0, 127, size=640).astype(np.uint7),)] 
-    circuit = compiler.compile(inputset)
-    return circuit
+
+    # The input-set spans the quantized range, so the cache key does not depend on random data
+    inputset = [np.zeros(dims, dtype=np.uint8), np.full(dims, max_value, dtype=np.uint8)]
+    return load_or_compile_circuit(encrypt_fn, {"x": "encrypted"}, inputset, "encryption", cache_dir=cache_dir)
 
 def create_database(db_name="data/fingerprints.db"):
     """Create an SQLite database and a table for storing fingerprint features."""
@@ -46,38 +78,359 @@ def create_database(db_name="data/fingerprints.db"):
     ''')
     conn.commit()
     conn.close()
-    print(f"Database {db_name} created with table fingerprints.")
+    logger.info("Database %s created with table fingerprints.", db_name)
+
+
+class FingerprintStore:
+    """
+    Long-lived connection to the fingerprint template store.
+    The connection runs in WAL mode with synchronous=NORMAL, so a commit appends to the
+    write-ahead log instead of syncing the database file, and writes are batched with
+    executemany inside a single transaction.
+    Callbacks registered with add_listener are called with the labels of every committed
+    insert or delete, so caches built on top of the store can drop stale entries.
+    Databases from before the unique label index may hold several rows per label; opening
+    one raises ValueError unless migrate=True, which keeps the newest row of each label.
+    """
+
+    def __init__(self, db_name="data/fingerprints.db", batch_size=500, migrate=False):
+        self.db_name = db_name
+        self.batch_size = batch_size
+        self.migrate = migrate
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-65536")  # 64 MiB page cache
+        self.conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB memory-mapped reads
+        try:
+            self._create_schema()
+        except Exception:
+            self.conn.close()
+            raise
+
+    def _create_schema(self):
+        """Create the fingerprints table, add columns missing from older databases and index label."""
+        with self.lock, self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS fingerprints (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    label TEXT NOT NULL,
+                    features BLOB NOT NULL,
+                    coarse_key BLOB,
+                    encoding BLOB
+                )
+            ''')
+            columns = [row[1] for row in self.conn.execute('PRAGMA table_info(fingerprints)')]
+            if 'coarse_key' not in columns:
+                self.conn.execute('ALTER TABLE fingerprints ADD COLUMN coarse_key BLOB')
+            if 'encoding' not in columns:
+                self.conn.execute('ALTER TABLE fingerprints ADD COLUMN encoding BLOB')
+            has_index = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_fingerprints_label'"
+            ).fetchone()
+            if not has_index:
+                # Older databases may hold duplicate labels; only an explicit migration drops them
+                duplicates = self.conn.execute(
+                    'SELECT COUNT(*) - COUNT(DISTINCT label) FROM fingerprints'
+                ).fetchone()[0]
+                if duplicates and not self.migrate:
+                    raise ValueError(f"{self.db_name} holds {duplicates} rows with duplicate labels; open it once "
+                                     f"with FingerprintStore({self.db_name!r}, migrate=True) to keep the newest "
+                                     f"row of each label and delete the others")
+                if duplicates:
+                    removed = self.conn.execute(
+                        'DELETE FROM fingerprints WHERE id NOT IN (SELECT MAX(id) FROM fingerprints GROUP BY label)'
+                    ).rowcount
+                    logger.warning("Removed %d rows with duplicate labels from %s.", removed, self.db_name)
+                self.conn.execute('CREATE UNIQUE INDEX idx_fingerprints_label ON fingerprints (label)')
+            # Source image of each template, so a directory sync can skip unchanged files
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS enrollment_sources (
+                    label TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL
+                )
+            ''')
+            # Settings the stored templates depend on, such as the version of their reducer
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS settings (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+
+    def _batches(self, rows):
+        """Split an iterable of rows into lists of at most batch_size rows."""
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def add_listener(self, callback):
+        """Call callback(labels) after every committed insert or delete."""
+        with self.lock:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """Stop notifying a callback registered with add_listener."""
+        with self.lock:
+            self.listeners.remove(callback)
+
+    def _notify(self, labels):
+        """Pass the labels touched by a committed transaction to every listener."""
+        for callback in list(self.listeners):
+            callback(labels)
+
+    def insert_many(self, rows):
+        """
+        Insert (label, encrypted features), (label, encrypted features, coarse key) or
+        (label, encrypted features, coarse key, encoding) rows in a single transaction. The
+        encoding is the output of secure_computation.encode_template. A label that is already
+        enrolled gets its features, coarse key and encoding replaced.
+        Returns the number of rows written.
+        """
+        labels = []
+        with self.lock:
+            with self.conn:
+                for batch in self._batches(rows):
+                    self.conn.executemany('''
+                        INSERT INTO fingerprints (label, features, coarse_key, encoding)
+                        VALUES (?, ?, ?, ?)
+                        ON CONFLICT (label) DO UPDATE SET features = excluded.features,
+                            coarse_key = excluded.coarse_key, encoding = excluded.encoding
+                    ''', [(row[0], row[1], row[2] if len(row) > 2 else None, row[3] if len(row) > 3 else None)
+                          for row in batch])
+                    labels.extend(row[0] for row in batch)
+            self._notify(labels)
+        return len(labels)
+
+    def insert(self, label, features):
+        """Insert or replace the encrypted features of a single label."""
+        return self.insert_many([(label, features)])
+
+    def delete_many(self, labels):
+        """Delete the entries of several labels in a single transaction. Returns the number removed."""
+        count = 0
+        labels = list(labels)
+        with self.lock:
+            with self.conn:
+                for batch in self._batches((label,) for label in labels):
+                    before = self.conn.total_changes
+                    self.conn.executemany('DELETE FROM fingerprints WHERE label = ?', batch)
+                    count += self.conn.total_changes - before
+                    self.conn.executemany('DELETE FROM enrollment_sources WHERE label = ?', batch)
+            self._notify(labels)
+        return count
+
+    def get(self, label):
+        """Return the encrypted features stored for a label, or None."""
+        with self.lock:
+            row = self.conn.execute('SELECT features FROM fingerprints WHERE label = ?', (label,)).fetchone()
+        return row[0] if row else None
+
+    def page(self, after_id=0, limit=64):
+        """
+        Return up to limit (id, label, features size) rows with an id greater than after_id.
+        Pages are read by id range, so no read transaction stays open between pages.
+        """
+        with self.lock:
+            return self.conn.execute(
+                'SELECT id, label, LENGTH(features) FROM fingerprints WHERE id > ? ORDER BY id LIMIT ?',
+                (after_id, limit)
+            ).fetchall()
+
+    def features_by_id(self, ids):
+        """Return a dict mapping each of the given row ids to its encrypted features."""
+        ids = list(ids)
+        if not ids:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT id, features FROM fingerprints WHERE id IN ({", ".join("?" * len(ids))})', ids
+            ).fetchall()
+        return dict(rows)
+
+    def sources(self):
+        """Return a dict mapping each label to the (path, size, mtime_ns, sha256) of its source image."""
+        with self.lock:
+            rows = self.conn.execute('SELECT label, path, size, mtime_ns, sha256 FROM enrollment_sources').fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def record_sources(self, rows):
+        """Insert or replace (label, path, size, mtime_ns, sha256) source rows in one transaction."""
+        rows = list(rows)
+        with self.lock, self.conn:
+            self.conn.executemany('''
+                INSERT INTO enrollment_sources (label, path, size, mtime_ns, sha256)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (label) DO UPDATE SET path = excluded.path, size = excluded.size,
+                    mtime_ns = excluded.mtime_ns, sha256 = excluded.sha256
+            ''', rows)
+        return len(rows)
+
+    def get_setting(self, name):
+        """Return the value of a setting, or None if it was never set."""
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, name, value):
+        """Insert or replace a setting."""
+        with self.lock, self.conn:
+            self.conn.execute('''
+                INSERT INTO settings (name, value) VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            ''', (name, value))
+
+    def coarse_keys(self):
+        """Return the (label, coarse key) pairs of every template enrolled with a coarse key."""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT label, coarse_key FROM fingerprints WHERE coarse_key IS NOT NULL ORDER BY id'
+            ).fetchall()
+
+    def encodings(self):
+        """Return the (label, encoding) pairs of every template enrolled with a precomputed encoding."""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT label, encoding FROM fingerprints WHERE encoding IS NOT NULL ORDER BY id'
+            ).fetchall()
+
+    def labels(self):
+        """Return every enrolled label."""
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT label FROM fingerprints ORDER BY id')]
+
+    def close(self):
+        """Checkpoint the write-ahead log and close the connection."""
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# One open store per database file, shared by every caller in the process
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_fingerprint_store(db_name="data/fingerprints.db"):
+    """Return the shared FingerprintStore of a database file, opening it on first use."""
+    with _stores_lock:
+        store = _stores.get(db_name)
+        if store is None:
+            store = _stores[db_name] = FingerprintStore(db_name)
+        return store
+
+
+def close_fingerprint_stores():
+    """Close every shared FingerprintStore."""
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
+
 
 
 # Stored as BLOB and not encrypted
 # Using ZAMA concrete library for encryption
-def insert_features_into_database(db_name, label, features, circuit):
-    """Insert encrypted fingerprint features into the SQLite database using the provided circuit."""
+@timed("db_insert")
+def insert_features_into_database(db_name, label, features, circuit, quantizer=None, reducer=None, store_encoding=False):
+    """
+    Insert encrypted fingerprint features into the SQLite database using the provided circuit.
+    With store_encoding, the template's precomputed Paillier encoding is stored next to it.
+    """
     if features is None:
-        print(f"Error: Feature vector for {label} is None. Skipping insertion.")
+        logger.error("Feature vector for %s is None. Skipping insertion.", label)
         return
     
-    # Encrypt and serialize the features using the same circuit
-    encrypted_features = encrypt_features(features, circuit)
+    # Quantize once, then encrypt and serialize the features using the same circuit
+    quantized_features = quantize_features(features, quantizer=quantizer, reducer=reducer)
+    encrypted_features = encrypt_quantized_features(quantized_features, circuit)
     
-    # Insert the serialized encrypted features into the database
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO fingerprints (label, features)
-        VALUES (?, ?)
-    ''', (label, encrypted_features))
-    conn.commit()
-    conn.close()
-    print(f"Successful insertion for {label} into the database.")
+    # Insert the serialized encrypted features through the shared store
+    if store_encoding:
+        encoding = encode_template(quantized_features, quantizer.max_value if quantizer else 127)
+        get_fingerprint_store(db_name).insert_many([(label, encrypted_features, None, encoding)])
+    else:
+        get_fingerprint_store(db_name).insert(label, encrypted_features)
+    increment("templates_inserted")
+    logger.debug("Successful insertion for %s into the database.", label)
 
 
 
 
-def create_and_populate_database(fingerprint_dir, db_name="data/fingerprints.db"):
-    """Create a database and populate it with fingerprint feature vectors using a single circuit."""
+def create_and_populate_database(fingerprint_dir, db_name="data/fingerprints.db", num_workers=None, num_loaders=4,
+                                 sync=False, remove_missing=False, quantizer=None, reducer=None, store_encodings=False):
+    """
+    Create a database and populate it with fingerprint feature vectors using a single circuit.
+    With num_workers set, the images go through the parallel enrollment pipeline instead.
+    With sync, only new or changed images are enrolled (see sync_directory), and
+    remove_missing also deletes the templates of images that are gone.
+    A fitted Quantizer is saved next to the database, its version recorded in the database,
+    and used for every template; without one, the quantizer already saved there (if any) is
+    reused. Enrolling with a quantizer other than the one the existing templates were
+    enrolled with raises ValueError.
+    A DimensionReducer is saved the same way and its version recorded in the database; it
+    needs a quantizer fitted on reduced features (Quantizer.fit with per_dimension=False),
+    passed or already saved, or ValueError is raised. Enrolling with a reducer other than
+    the one the existing templates were enrolled with raises ValueError.
+    With store_encodings, every template also gets its precomputed Paillier encoding
+    (secure_computation.GalleryEncoding).
+    """
+    store = get_fingerprint_store(db_name)
+    recorded_quantizer = store.get_setting("quantizer_version")
+    if recorded_quantizer is None and os.path.exists(quantizer_path(db_name)):
+        # Saved before versions were recorded
+        recorded_quantizer = load_quantizer(db_name).version
+        store.set_setting("quantizer_version", recorded_quantizer)
+    if quantizer is None:
+        quantizer = load_quantizer(db_name, recorded_quantizer)
+    elif quantizer.version != recorded_quantizer:
+        if store.labels():
+            raise ValueError(f"{db_name} holds templates enrolled with quantizer "
+                             f"{recorded_quantizer or 'per-vector scaling'}, not {quantizer.version}; "
+                             f"enroll into a new database")
+        quantizer.save(quantizer_path(db_name))
+        store.set_setting("quantizer_version", quantizer.version)
+    recorded_version = store.get_setting("reducer_version")
+    if reducer is None:
+        reducer = load_reducer(db_name, recorded_version)
+    if reducer is not None and quantizer is None:
+        raise ValueError(f"{db_name} uses a reducer, which needs a Quantizer fitted on reduced features "
+                         f"(per_dimension=False)")
+    if reducer is not None and reducer.version != recorded_version:
+        if store.labels():
+            raise ValueError(f"{db_name} holds templates enrolled with reducer {recorded_version}, "
+                             f"not {reducer.version}; enroll into a new database")
+        reducer.save(reducer_path(db_name))
+        store.set_setting("reducer_version", reducer.version)
+    if sync:
+        from .enrollment import sync_directory
+        return sync_directory(fingerprint_dir, db_name, remove_missing=remove_missing,
+                              num_loaders=num_loaders, num_workers=num_workers, quantizer=quantizer, reducer=reducer,
+                              store_encodings=store_encodings)
+    if num_workers is not None:
+        from .enrollment import run_enrollment_pipeline
+        return run_enrollment_pipeline(fingerprint_dir, db_name, num_loaders=num_loaders, num_workers=num_workers,
+                                       quantizer=quantizer, reducer=reducer, store_encodings=store_encodings)
+
     # Generate the circuit once
-    circuit = get_encryption_circuit()
+    circuit = get_encryption_circuit(max_value=quantizer.max_value if quantizer else 127,
+                                     dims=reducer.dims if reducer else 640)
     create_database(db_name)
 
     for filename in os.listdir(fingerprint_dir):
@@ -86,20 +439,22 @@ def create_and_populate_database(fingerprint_dir, db_name="data/fingerprints.db"
             try:
                 enhanced_image = load_and_preprocess_image(image_path)
                 if enhanced_image is None:
-                    print(f"Skipping {filename}: Failed to process image.")
+                    logger.warning("Skipping %s: Failed to process image.", filename)
                     continue
                 
                 finger_code_features = extract_fingercode_features(enhanced_image)
                 if finger_code_features is None:
-                    print(f"Skipping {filename}: Failed to extract features.")
+                    logger.warning("Skipping %s: Failed to extract features.", filename)
                     continue
 
                 label = os.path.splitext(filename)[0]
-                print(f"Feature vector - plain text - {finger_code_features[:10]}....")
-                insert_features_into_database(db_name, label, finger_code_features, circuit)
-                print(f"Processed {filename} - Features inserted into the database.")
+                logger.debug("Feature vector - plain text - %s....", finger_code_features[:10])
+                insert_features_into_database(db_name, label, finger_code_features, circuit, quantizer, reducer,
+                                              store_encodings)
+                logger.info("Processed %s - Features inserted into the database.", filename)
             except Exception as e:
-                print(f"Failed to process {filename}: {e}")
+                increment("enrollment_failures")
+                logger.error("Failed to process %s: %s", filename, e)
 
 def deserialize_encrypted_features(encrypted_blob, circuit):
     """Deserialize the encrypted features using the same circuit."""
@@ -107,48 +462,46 @@ def deserialize_encrypted_features(encrypted_blob, circuit):
     return encrypted_value
 
 
-def view_encrypted_data(db_name="data/fingerprints.db", circuit=None):
+def view_encrypted_data(db_name="data/fingerprints.db", circuit=None, page_size=64):
     """
-    Retrieve and display encrypted features from the database.
+    Retrieve and display encrypted features from the database, page_size rows at a time.
     Optionally deserialize the encrypted data if a circuit is provided.
+    The database is opened read-only, so displaying it never changes or migrates it.
     """
     if circuit is None:
         print("Warning: No circuit provided. Encrypted data will not be deserialized.")
-    
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-    cursor.execute("SELECT label, features FROM fingerprints")
-    rows = cursor.fetchall()
-    conn.close()
 
-    for row in rows:
-        label = row[0]
-        encrypted_blob = row[1]
-        print(f"Label: {label}")
-        print(f"Encrypted Features (BLOB): {encrypted_blob[:100]}...")  # Print part of the BLOB
-        print(f"Length of Encrypted Features: {len(encrypted_blob)}")
+    conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True)
+    try:
+        after_id = 0
+        while True:
+            rows = conn.execute(
+                'SELECT id, label, features FROM fingerprints WHERE id > ? ORDER BY id LIMIT ?', (after_id, page_size)
+            ).fetchall()
+            if not rows:
+                break
+            for row_id, label, encrypted_blob in rows:
+                print(f"Label: {label}")
+                print(f"Encrypted Features (BLOB): {encrypted_blob[:100]}...")  # Print part of the BLOB
+                print(f"Length of Encrypted Features: {len(encrypted_blob)}")
 
-        # Deserialize the encrypted features if the circuit is provided
-        if circuit:
-            try:
-                encrypted_value = deserialize_encrypted_features(encrypted_blob, circuit)
-                print(f"Deserialized Encrypted Value: {encrypted_value[:10]}")
-                decrypted_features = circuit.decrypt(encrypted_value)
-                print(f"Decrypted Features: {decrypted_features[:10]}...")
-            except Exception as e:
-                print(f"Error deserializing encrypted data for {label}: {e}")
+                # Deserialize the encrypted features if the circuit is provided
+                if circuit is not None:
+                    try:
+                        encrypted_value = deserialize_encrypted_features(encrypted_blob, circuit)
+                        print(f"Deserialized Encrypted Value: {encrypted_value}")
+                        decrypted_features = circuit.decrypt(encrypted_value)
+                        print(f"Decrypted Features: {decrypted_features[:10]}...")
+                    except Exception as e:
+                        print(f"Error deserializing encrypted data for {label}: {e}")
+            after_id = rows[-1][0]
+    finally:
+        conn.close()
 
 def delete_data_from_database(db_name, label):
     """Delete a fingerprint entry from the SQLite database based on the label."""
-    conn = sqlite3.connect(db_name)
-    cursor = conn.cursor()
-
     # Delete the entry from the fingerprints table where the label matches
-    cursor.execute('DELETE FROM fingerprints WHERE label = ?', (label,))
-
-    # Commit the changes and close the connection
-    conn.commit()
-    conn.close()
+    get_fingerprint_store(db_name).delete_many([label])
 
     print(f"Entry with label '{label}' deleted from the database.")
 
@@ -193,4 +546,4 @@ def delete_data_from_database(db_name, label):
 #         return features
 #     else:
 #         print(f"No entry found for label: {label}")
-#         return None                
\ No newline at end of file
+#         return None                
\ No newline at end of file
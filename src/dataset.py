@@ -0,0 +1,103 @@
+# src/dataset.py
+import argparse
+import json
+import logging
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from .metrics import logger
+
+# images: (N, H, W) uint8 array (memory-mapped), subjects: (N,) uint16, filenames: list of N names
+Pack = namedtuple("Pack", ["images", "subjects", "filenames"])
+
+
+def _pack_paths(pack_dir, name):
+    """Paths of the image stack, subject labels and filename index of a pack (np_data naming)."""
+    return (
+        os.path.join(pack_dir, f"img_{name}.npy"),
+        os.path.join(pack_dir, f"label_{name}.npy"),
+        os.path.join(pack_dir, f"index_{name}.json"),
+    )
+
+
+def pack_directory(image_dir, pack_dir, name):
+    """
+    Decode every image of a directory once and write them as a single contiguous uint8
+    stack img_{name}.npy, next to label_{name}.npy (subject ids, as in np_data) and
+    index_{name}.json (the source filenames, in stack order).
+    The subject of an image is the filename part before "_" (FVC naming, e.g. 00003_12.bmp).
+    All images must have the same size. Returns the number of packed images.
+    """
+    filenames = sorted(f for f in os.listdir(image_dir) if f.endswith((".bmp", ".jpg", ".png")))
+    if not filenames:
+        raise ValueError(f"No images found in {image_dir}")
+    os.makedirs(pack_dir, exist_ok=True)
+    image_path, label_path, index_path = _pack_paths(pack_dir, name)
+
+    first = cv2.imread(os.path.join(image_dir, filenames[0]), cv2.IMREAD_GRAYSCALE)
+    if first is None:
+        raise ValueError(f"Could not read {filenames[0]}")
+    # Written row by row through a memmap, so the whole stack is never held in memory
+    images = np.lib.format.open_memmap(image_path, mode="w+", dtype=np.uint8, shape=(len(filenames),) + first.shape)
+    for row, filename in enumerate(filenames):
+        image = first if row == 0 else cv2.imread(os.path.join(image_dir, filename), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError(f"Could not read {filename}")
+        if image.shape != first.shape:
+            raise ValueError(f"{filename} is {image.shape}, expected {first.shape} like the other images")
+        images[row] = image
+    images.flush()
+    del images
+
+    subject_names = [os.path.splitext(filename)[0].split("_")[0] for filename in filenames]
+    subject_ids = {subject: i for i, subject in enumerate(sorted(set(subject_names)))}
+    subjects = np.array([int(s) if s.isdigit() else subject_ids[s] for s in subject_names], dtype=np.uint16)
+    np.save(label_path, subjects[:, np.newaxis])
+    with open(index_path, "w") as f:
+        json.dump({"image_dir": image_dir, "filenames": filenames}, f)
+    logger.info("Packed %d images from %s into %s.", len(filenames), image_dir, image_path)
+    return len(filenames)
+
+
+def load_pack(pack_dir, name):
+    """
+    Open a pack written by pack_directory without reading it: the image stack is memory-mapped.
+    Also works for the np_data stacks of the FVC dataset (img_real.npy, (N, H, W, 1)); without
+    an index file the filenames are the row numbers, as in real_data.
+    """
+    image_path, label_path, index_path = _pack_paths(pack_dir, name)
+    images = np.load(image_path, mmap_mode="r")
+    if images.ndim == 4 and images.shape[3] == 1:
+        images = images[..., 0]
+    subjects = np.load(label_path).reshape(-1) if os.path.exists(label_path) else np.arange(len(images), dtype=np.uint16)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            filenames = json.load(f)["filenames"]
+    else:
+        filenames = [f"{row:05d}.bmp" for row in range(len(images))]
+    if not len(images) == len(subjects) == len(filenames):
+        raise ValueError(f"Pack {name} in {pack_dir} has mismatched image, label and index lengths")
+    return Pack(images, subjects, filenames)
+
+
+def iter_pack_chunks(pack, chunk_size=64):
+    """Yield (filenames, images) chunks of a pack; images are views into the memory map, not copies."""
+    for start in range(0, len(pack.filenames), chunk_size):
+        yield pack.filenames[start:start + chunk_size], pack.images[start:start + chunk_size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack an image directory into a memory-mappable .npy stack")
+    parser.add_argument("image_dir")
+    parser.add_argument("pack_dir")
+    parser.add_argument("name")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    pack_directory(args.image_dir, args.pack_dir, args.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# src/enrollment.py
+import hashlib
+import os
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .circuit_cache import CachedCircuit
+from .preprocessing import load_and_preprocess_image, preprocess_image, extract_fingercode_features_batch
+from .database import get_encryption_circuit, get_fingerprint_store, quantize_features
+from .metrics import logger, span, increment
+from .secure_computation import encode_template
+
+# Concrete circuit, coarse projection, quantizer, reducer and encoding range of a worker process, set up once by _init_worker
+_worker_circuit = None
+_worker_projection = None
+_worker_quantizer = None
+_worker_reducer = None
+_worker_encoding_max_value = None
+
+
+def _init_worker(circuit_path, projection=None, quantizer=None, reducer=None, encoding_max_value=None):
+    """Load the circuit and its keys from the circuit cache once per worker process."""
+    global _worker_circuit, _worker_projection, _worker_quantizer, _worker_reducer, _worker_encoding_max_value
+    _worker_circuit = CachedCircuit.load(circuit_path)
+    _worker_projection = projection
+    _worker_quantizer = quantizer
+    _worker_reducer = reducer
+    _worker_encoding_max_value = encoding_max_value
+
+
+def _extract_and_encrypt(filenames, labels, images):
+    """Extract, quantize and encrypt a chunk of preprocessed images in a worker process."""
+    results = []
+    try:
+        features = extract_fingercode_features_batch(images)
+    except Exception as e:
+        return [(filename, label, None, None, None, f"Failed to extract features: {e}") for filename, label in zip(filenames, labels)]
+
+    quantized = quantize_features(features, quantizer=_worker_quantizer, reducer=_worker_reducer)
+    for filename, label, quantized_features in zip(filenames, labels, quantized):
+        try:
+            encrypted_bytes = _worker_circuit.encrypt(quantized_features).serialize()
+            coarse_key = _worker_projection.to_bytes(quantized_features) if _worker_projection else None
+            encoding = None
+            if _worker_encoding_max_value is not None:
+                encoding = encode_template(quantized_features, _worker_encoding_max_value)
+            results.append((filename, label, encrypted_bytes, coarse_key, encoding, None))
+        except Exception as e:
+            results.append((filename, label, None, None, None, str(e)))
+    return results
+
+
+def _put(bounded_queue, item, stop):
+    """Put an item on a bounded queue, giving up once stop is set. Returns False if it gave up."""
+    while not stop.is_set():
+        try:
+            bounded_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(bounded_queue, stop):
+    """Get an item from a queue, waiting until one arrives or stop is set (then returns None)."""
+    while not stop.is_set():
+        try:
+            return bounded_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def _load_images(filenames, fingerprint_dir, loaded, failures, stop, pack=None):
+    """
+    Decode and preprocess images until the shared file queue is empty or stop is set (thread stage).
+    With a pack (src.dataset), images are read from its memory-mapped stack instead of decoded.
+    """
+    rows = {filename: row for row, filename in enumerate(pack.filenames)} if pack is not None else None
+    while not stop.is_set():
+        try:
+            filename = filenames.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            if pack is not None:
+                enhanced_image = preprocess_image(pack.images[rows[filename]])
+            else:
+                enhanced_image = load_and_preprocess_image(os.path.join(fingerprint_dir, filename))
+            if enhanced_image is None:
+                failures.append((filename, "Failed to process image."))
+                continue
+            if not _put(loaded, (filename, os.path.splitext(filename)[0], enhanced_image), stop):
+                return
+        except Exception as e:
+            failures.append((filename, str(e)))
+
+
+def _run_loaders(filenames, fingerprint_dir, loaded, failures, num_loaders, stop, pack=None):
+    """Run the loader threads and close the loaded queue once the file queue is drained."""
+    try:
+        with ThreadPoolExecutor(max_workers=num_loaders) as loaders:
+            for _ in range(num_loaders):
+                loaders.submit(_load_images, filenames, fingerprint_dir, loaded, failures, stop, pack)
+    finally:
+        _put(loaded, None, stop)
+
+
+def _dispatch_chunks(loaded, pending, executor, chunk_size, stop, failures):
+    """
+    Group preprocessed images into chunks and hand them to the process pool, until the end or stop.
+    If the pool breaks or is shut down, the remaining images are recorded as failures, and the
+    end of the chunks is still signalled so the writer leaves its loop.
+    """
+    chunk = []
+    broken = None
+    while True:
+        item = _get(loaded, stop)
+        if stop.is_set():
+            return
+        if item is not None:
+            chunk.append(item)
+        if broken is not None:
+            failures.extend((filename, broken) for filename, _, _ in chunk)
+            chunk = []
+        elif chunk and (item is None or len(chunk) == chunk_size):
+            filenames, labels, images = zip(*chunk)
+            chunk = []
+            try:
+                future = executor.submit(_extract_and_encrypt, filenames, labels, images)
+            except RuntimeError as e:  # BrokenProcessPool, or the pool was shut down
+                broken = f"Process pool unavailable: {e}"
+                failures.extend((filename, broken) for filename in filenames)
+            else:
+                if not _put(pending, (filenames, future), stop):
+                    return
+        if item is None:
+            _put(pending, None, stop)
+            return
+
+
+def run_enrollment_pipeline(fingerprint_dir, db_name="data/fingerprints.db", circuit=None,
+                            num_loaders=4, num_workers=None, chunk_size=16, queue_size=64, store=None,
+                            projection=None, filenames=None, pack=None, quantizer=None, reducer=None,
+                            store_encodings=False):
+    """
+    Enroll every image of a directory with a staged pipeline.
+    A thread pool decodes and preprocesses images, a process pool extracts, quantizes and
+    encrypts chunks of them, and a single writer inserts the results into the database.
+    The stages are connected by bounded queues, so memory stays flat on large directories.
+    Workers load the circuit's keys from its cache entry (see get_encryption_circuit).
+    store defaults to the pooled FingerprintStore of db_name; a SegmentStore can be passed instead.
+    With a CoarseProjection, the coarse key of every template is stored next to it
+    (FingerprintStore only), for pruned_secure_distance_computation.
+    filenames restricts the run to those files of the directory (used by sync_directory).
+    With a pack from src.dataset.load_pack, images come from the packed stack and
+    fingerprint_dir is only used in messages.
+    With a fitted Quantizer (src.quantization) every template is quantized on its common
+    scale, and the default circuit is compiled for its bit width. A DimensionReducer
+    (src.reduction) is applied before quantization and requires such a quantizer, fitted on
+    reduced features with per_dimension=False; the circuit then takes reducer.dims values.
+    With store_encodings, the precomputed Paillier encoding of every template
+    (secure_computation.encode_template) is stored next to it (FingerprintStore only), for
+    GalleryEncoding; it holds the quantized template in clear.
+    Returns the number of inserted templates and the list of (filename, reason) failures.
+    """
+    if reducer is not None and quantizer is None:
+        raise ValueError("A reducer needs a Quantizer fitted on reduced features (per_dimension=False)")
+    if circuit is None:
+        circuit = get_encryption_circuit(max_value=quantizer.max_value if quantizer else 127,
+                                         dims=reducer.dims if reducer else 640)
+    if store is None:
+        store = get_fingerprint_store(db_name)
+    num_workers = num_workers or os.cpu_count() or 1
+
+    if filenames is None and pack is not None:
+        filenames = pack.filenames
+    elif filenames is None:
+        filenames = [f for f in os.listdir(fingerprint_dir) if f.endswith((".bmp", ".jpg", ".png"))]
+    file_queue = queue.Queue()
+    for filename in sorted(filenames):
+        file_queue.put(filename)
+
+    loaded = queue.Queue(maxsize=queue_size)
+    # Chunks are submitted in order and the queue bounds how many are in flight
+    pending = queue.Queue(maxsize=max(1, queue_size // chunk_size))
+    failures = []
+    inserted = 0
+
+    executor = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(circuit.path, projection, quantizer, reducer,
+                  (quantizer.max_value if quantizer else 127) if store_encodings else None),
+    )
+    # Set when the writer fails, so the loader and dispatcher threads stop instead of blocking on full queues
+    stop = threading.Event()
+    loader = threading.Thread(target=_run_loaders, args=(file_queue, fingerprint_dir, loaded, failures, num_loaders, stop, pack), daemon=True)
+    dispatcher = threading.Thread(target=_dispatch_chunks, args=(loaded, pending, executor, chunk_size, stop, failures), daemon=True)
+    loader.start()
+    dispatcher.start()
+
+    # The calling thread is the single database writer
+    try:
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            chunk_filenames, future = item
+            try:
+                results = future.result()
+            except Exception as e:
+                failures.extend((filename, str(e)) for filename in chunk_filenames)
+                continue
+            rows = []
+            for filename, label, encrypted_bytes, coarse_key, encoding, error in results:
+                if error is not None:
+                    failures.append((filename, error))
+                    continue
+                if store_encodings:
+                    rows.append((label, encrypted_bytes, coarse_key, encoding))
+                else:
+                    rows.append((label, encrypted_bytes, coarse_key) if projection else (label, encrypted_bytes))
+            with span("db_insert_batch"):
+                inserted += store.insert_many(rows)
+            increment("templates_enrolled", len(rows))
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        executor.shutdown(cancel_futures=stop.is_set())
+        loader.join()
+        dispatcher.join()
+
+    increment("enrollment_failures", len(failures))
+    for filename, reason in failures:
+        logger.debug("Failed to process %s: %s", filename, reason)
+    if failures:
+        logger.warning("%d files failed to enroll, e.g. %s: %s", len(failures), *failures[0])
+    logger.info("Inserted %d templates into %s (%d failures).", inserted, db_name, len(failures))
+    return inserted, failures
+
+
+def _file_sha256(path, chunk_size=1 << 20):
+    """Return the hex SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sync_directory(fingerprint_dir, db_name="data/fingerprints.db", remove_missing=False, store=None, **pipeline_args):
+    """
+    Bring the database in line with a directory of images, enrolling only what changed.
+    A file whose size and mtime match its recorded source is skipped without being read;
+    otherwise its SHA-256 is compared with the recorded one, so a touched, copied or moved but
+    identical file only has its source updated. Sources are recorded by real path, so the
+    same directory reached as data/x, data/x/, ./data/x or an absolute path matches. New and changed files go through run_enrollment_pipeline
+    (which upserts by label), and their sources are recorded once they are inserted, so a
+    failed or interrupted run is simply retried next time.
+    With remove_missing, templates whose source file is gone are deleted.
+    Returns a dict with the counts of unchanged, enrolled, removed and failed files.
+    """
+    store = store or get_fingerprint_store(db_name)
+    recorded = store.sources()
+    changed = {}
+    touched = []
+    unchanged = 0
+    present = set()
+    for filename in sorted(os.listdir(fingerprint_dir)):
+        if not filename.endswith((".bmp", ".jpg", ".png")):
+            continue
+        label = os.path.splitext(filename)[0]
+        present.add(label)
+        path = os.path.realpath(os.path.join(fingerprint_dir, filename))
+        stat = os.stat(path)
+        source = recorded.get(label)
+        if source and source[0] == path and source[1:3] == (stat.st_size, stat.st_mtime_ns):
+            unchanged += 1
+            continue
+        sha256 = _file_sha256(path)
+        row = (label, path, stat.st_size, stat.st_mtime_ns, sha256)
+        if source and source[3] == sha256:
+            touched.append(row)
+            unchanged += 1
+        else:
+            changed[filename] = row
+    store.record_sources(touched)
+
+    enrolled, failures = 0, []
+    if changed:
+        enrolled, failures = run_enrollment_pipeline(fingerprint_dir, db_name, store=store,
+                                                     filenames=list(changed), **pipeline_args)
+        failed = {filename for filename, _ in failures}
+        store.record_sources(row for filename, row in changed.items() if filename not in failed)
+
+    removed = 0
+    if remove_missing:
+        removed = store.delete_many(sorted(set(recorded) - present))
+    logger.info("Synced %s: %d unchanged, %d enrolled, %d removed, %d failed.",
+                fingerprint_dir, unchanged, enrolled, removed, len(failures))
+    return {"unchanged": unchanged, "enrolled": enrolled, "removed": removed, "failed": len(failures)}
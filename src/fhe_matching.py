@@ -0,0 +1,293 @@
+# src/fhe_matching.py
+import inspect
+from collections import namedtuple
+
+import numpy as np
+from concrete import fhe
+from .circuit_cache import DEFAULT_CACHE_DIR, load_or_compile_circuit, load_or_compile_module
+
+
+def _clear_gallery_distances(probe, gallery, gallery_norms):
+    """||g||^2 - 2 g.x for every row g of a clear gallery chunk (no bootstrapping needed)."""
+    return gallery_norms - 2 * (gallery @ probe)
+
+
+def _encrypted_gallery_distances(probe, gallery):
+    """||g - x||^2 for every row g of an encrypted gallery chunk (one table lookup per element)."""
+    return np.sum((gallery - probe) ** 2, axis=1)
+
+
+def get_distance_circuit(chunk_size=64, dims=640, max_value=127, encrypted_gallery=False, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Load the circuit comparing one encrypted probe with a chunk of chunk_size templates.
+    With a clear gallery the circuit only does linear operations and returns
+    ||g||^2 - 2 g.x, the same quantity as the Paillier kernel; the missing ||x||^2 is
+    constant per probe, so the ranking is unchanged. With encrypted_gallery the templates
+    are encrypted too and the circuit returns ||g - x||^2, at the cost of one programmable
+    bootstrap per element and much larger keys.
+    """
+    # Extreme probes and templates bound every intermediate value of the circuit
+    inputset = []
+    for probe_value in (0, max_value):
+        for gallery_value in (0, max_value):
+            probe = np.full(dims, probe_value, dtype=np.int64)
+            gallery = np.full((chunk_size, dims), gallery_value, dtype=np.int64)
+            if encrypted_gallery:
+                inputset.append((probe, gallery))
+            else:
+                norms = np.full(chunk_size, dims * gallery_value * gallery_value, dtype=np.int64)
+                inputset.append((probe, gallery, norms))
+
+    if encrypted_gallery:
+        function, parameters = _encrypted_gallery_distances, {"probe": "encrypted", "gallery": "encrypted"}
+    else:
+        function, parameters = _clear_gallery_distances, {"probe": "encrypted", "gallery": "clear", "gallery_norms": "clear"}
+    mode = "encrypted" if encrypted_gallery else "clear"
+    name = f"distance-{mode}-{chunk_size}x{dims}-{max_value}"
+    return load_or_compile_circuit(function, parameters, inputset, name, cache_dir=cache_dir)
+
+
+def _gallery_chunks(gallery, chunk_size):
+    """Split a gallery into chunk_size rows, padding the last chunk with zero templates."""
+    gallery = np.asarray(gallery, dtype=np.int64)
+    padding = -len(gallery) % chunk_size
+    if padding:
+        gallery = np.concatenate([gallery, np.zeros((padding, gallery.shape[1]), dtype=np.int64)])
+    return gallery.reshape(-1, chunk_size, gallery.shape[1])
+
+
+def _input_count(circuit):
+    """Number of inputs of a compiled circuit."""
+    return len(circuit.client.specs.program_info.input_signs())
+
+
+def encrypt_probe(circuit, probe):
+    """Encrypt a quantized probe for the distance circuit (client side)."""
+    arguments = [None] * _input_count(circuit)
+    arguments[0] = np.asarray(probe, dtype=np.int64)
+    return circuit.encrypt(*arguments)[0]
+
+
+def encrypt_gallery(circuit, gallery, chunk_size):
+    """
+    Prepare the gallery as circuit inputs, one tuple per chunk.
+    A clear gallery is only wrapped with its squared norms; an encrypted gallery is encrypted
+    with the circuit's keys.
+    """
+    chunks = []
+    for chunk in _gallery_chunks(gallery, chunk_size):
+        if _input_count(circuit) == 2:
+            chunks.append(circuit.encrypt(None, chunk)[1:])
+        else:
+            chunks.append(circuit.encrypt(None, chunk, np.sum(chunk * chunk, axis=1))[1:])
+    return chunks
+
+
+def fhe_gallery_distances(circuit, encrypted_probe, gallery_chunks):
+    """Compare an encrypted probe with every gallery chunk, one circuit.run per chunk (server side)."""
+    return [circuit.run(encrypted_probe, *chunk) for chunk in gallery_chunks]
+
+
+def decrypt_gallery_distances(circuit, encrypted_distances, gallery_size):
+    """Decrypt the per-chunk results into one array of gallery_size distances (client side)."""
+    distances = [np.atleast_1d(circuit.decrypt(result)) for result in encrypted_distances]
+    return np.concatenate(distances)[:gallery_size]
+
+
+# Decision circuits: the server reduces the gallery to its best match or a match bit under encryption
+DecisionLayout = namedtuple("DecisionLayout", ["mode", "chunk_size", "dims", "max_value", "bits", "index_bits"])
+
+
+def decision_layout(mode="argmin", chunk_size=8, dims=32, max_value=3, max_chunks=128):
+    """
+    Describe a decision module over quantized vectors of dims values in [0, max_value].
+    bits is the width of the compared values: the distances for threshold, the
+    (distance, row) keys for argmin. Every bit of an argmin key costs table lookups in each
+    round of the tournament, and Concrete keeps encrypted values below 16 bits, so argmin
+    needs small, reduced vectors (src.reduction, src.quantization; 32 dims at 2 bits and
+    8 templates per chunk is 12 bits). threshold works at any size, but its keys grow with
+    the width of the distances. index_bits is the width of the chunk index an argmin result
+    carries, so a gallery can span at most max_chunks chunks.
+    """
+    if mode not in ("argmin", "threshold"):
+        raise ValueError(f"mode must be argmin or threshold, got {mode!r}")
+    largest = dims * max_value * max_value
+    if mode == "argmin":
+        bits = (largest * chunk_size + chunk_size - 1).bit_length()
+        if bits >= 16:
+            raise ValueError(f"argmin needs (dims * max_value^2 + 1) * chunk_size < 2^15, "
+                             f"got ({dims} * {max_value}^2 + 1) * {chunk_size}")
+    else:
+        bits = largest.bit_length()
+    return DecisionLayout(mode, chunk_size, dims, max_value, bits, max(1, (max_chunks - 1).bit_length()))
+
+
+def _decision_inputsets(layout):
+    """
+    Input-sets of the chunk and merge functions. For chunk: extreme probes and chunks
+    bounding every intermediate value, namely uniform chunks, and for every bit of the row
+    index the chunks whose rows are 0 or max_value by that bit, so each round of the argmin
+    tournament sees both of its halves win. For merge: the extreme results of chunk.
+    """
+    dims, max_value, chunk_size = layout.dims, layout.max_value, layout.chunk_size
+    rows = np.arange(chunk_size)[:, np.newaxis]
+    chunks = [np.zeros((chunk_size, dims), dtype=np.int64), np.full((chunk_size, dims), max_value, dtype=np.int64)]
+    for bit in range((chunk_size - 1).bit_length()):
+        high = (rows >> bit) & 1 == 1
+        chunks.append(np.where(high, max_value, 0) * np.ones(dims, dtype=np.int64))
+        chunks.append(np.where(high, 0, max_value) * np.ones(dims, dtype=np.int64))
+    if layout.mode == "threshold":
+        extras = [_threshold_offset(layout, threshold) for threshold in (0, dims * max_value * max_value)]
+        merge_inputset = [(first, second) for first in (0, 1) for second in (0, 1)]
+    else:
+        extras = [0, 2 ** layout.index_bits - 1]
+        results = [(key, index) for key in (0, 2 ** layout.bits - 1) for index in extras]
+        merge_inputset = [first + second for first in results for second in results]
+    chunk_inputset = []
+    for probe_value in (0, max_value):
+        probe = np.full(dims, probe_value, dtype=np.int64)
+        for gallery in chunks:
+            sample = (probe, int(probe @ probe), gallery, np.sum(gallery * gallery, axis=1))
+            chunk_inputset.extend(sample + (extra,) for extra in extras)
+    return {"chunk": chunk_inputset, "merge": merge_inputset}
+
+
+def _threshold_offset(layout, threshold):
+    """Clear input of the threshold module: 2^bits - threshold."""
+    if not 0 <= threshold <= layout.dims * layout.max_value * layout.max_value:
+        raise ValueError(f"threshold must be between 0 and dims * max_value^2, got {threshold}")
+    return 2 ** layout.bits - int(threshold)
+
+
+def _masked(condition, value, bits):
+    """value if the encrypted bit condition is set, else 0, for a value of the given width."""
+    masked = 0
+    for bit in range(bits):
+        # The hint keeps condition + bit 2 bits wide even where the input-set never set both
+        masked = masked + fhe.bits(fhe.hint(condition + fhe.bits(value)[bit], bit_width=2))[1] * 2 ** bit
+    return masked
+
+
+def get_decision_circuit(layout, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Load the module deciding a whole gallery for one encrypted probe, in two stages.
+    chunk compares the probe, sent encrypted with its squared norm, with layout.chunk_size
+    clear templates and computes the exact ||g - x||^2 of each, then under encryption
+        argmin     packs every distance with its row into the key distance * chunk_size + row,
+                   finds the smallest key by a tournament of pairwise minimums and returns
+                   it with the chunk's index
+        threshold  returns 1 if any template is closer than the threshold
+    merge reduces two such results to one: the smaller key and its chunk index (the first
+    on ties), or the OR of the match bits. Its outputs are wired back to its inputs, so the
+    server folds all chunk results into a single one (fhe_gallery_decisions) and the
+    response is one result per query whatever the gallery size. Comparisons extract the
+    sign bit of a difference shifted by 2^bits (for threshold, the clear input
+    2^bits - threshold), since Concrete's own min and comparisons need far larger keys at
+    these widths.
+    """
+    chunk_size, bits, index_bits = layout.chunk_size, layout.bits, layout.index_bits
+
+    def _smaller(first, second):
+        """min(first, second) of two keys, and 1 where first is the larger or equal."""
+        difference = fhe.hint(first - second + 2 ** bits, bit_width=bits + 1)
+        larger = fhe.bits(difference)[bits]
+        # first - min(first, second) is the difference where first is larger, else 0
+        return first - _masked(larger, difference, bits), larger
+
+    if layout.mode == "argmin":
+        def chunk(probe, probe_norm, gallery, gallery_norms, chunk_index):
+            distances = probe_norm + gallery_norms - 2 * (gallery @ probe)
+            keys = distances * chunk_size + np.arange(chunk_size)
+            while keys.size > 1:
+                half = keys.size // 2
+                smaller, _ = _smaller(keys[:half], keys[half:2 * half])
+                keys = np.concatenate([smaller, keys[2 * half:]]) if keys.size % 2 else smaller
+            # Outputs fed back to merge must not carry the noise of the inputs
+            index = fhe.zero() + chunk_index
+            return fhe.refresh(fhe.hint(keys[0], bit_width=bits)), fhe.refresh(fhe.hint(index, bit_width=index_bits))
+
+        def merge(first_key, first_index, second_key, second_index):
+            # Compared as (second, first), so equal keys keep the first, lower chunk
+            key, first_kept = _smaller(second_key, first_key)
+            index = second_index - _masked(first_kept, second_index, index_bits) + _masked(first_kept, first_index, index_bits)
+            return fhe.refresh(fhe.hint(key, bit_width=bits)), fhe.refresh(fhe.hint(index, bit_width=index_bits))
+
+        last = {"chunk_index": "clear"}
+        outputs = 2
+    else:
+        def chunk(probe, probe_norm, gallery, gallery_norms, threshold_offset):
+            shifted = probe_norm + gallery_norms - 2 * (gallery @ probe) + threshold_offset
+            return np.sum(1 - fhe.bits(shifted)[bits]) > 0
+
+        def merge(first, second):
+            return fhe.hint(first + second, bit_width=2) > 0
+
+        last = {"threshold_offset": "clear"}
+        outputs = 1
+
+    chunk_parameters = {"probe": "encrypted", "probe_norm": "encrypted", "gallery": "clear", "gallery_norms": "clear", **last}
+    merge_parameters = {name: "encrypted" for name in inspect.signature(merge).parameters}
+    wires = [(source, output, "merge", side * outputs + output)
+             for source in ("chunk", "merge") for output in range(outputs) for side in (0, 1)]
+    name = f"decision-{layout.mode}-{chunk_size}x{layout.dims}-{layout.max_value}"
+    return load_or_compile_module([(chunk, chunk_parameters), (merge, merge_parameters)],
+                                  _decision_inputsets(layout), wires, name, cache_dir=cache_dir)
+
+
+def encrypt_decision_probe(circuit, probe):
+    """Encrypt a quantized probe and its squared norm for a decision module (client side)."""
+    probe = np.asarray(probe, dtype=np.int64)
+    return circuit.encrypt(probe, int(probe @ probe), None, None, None, function_name="chunk")[:2]
+
+
+def prepare_decision_gallery(circuit, gallery, layout, threshold=None):
+    """
+    Wrap the clear gallery as chunk inputs, one tuple per chunk.
+    The last chunk is padded by repeating the last template: a copy never beats the original,
+    whose key has the lower row, and does not change whether a chunk matches.
+    """
+    gallery = np.asarray(gallery, dtype=np.int64)
+    padding = -len(gallery) % layout.chunk_size
+    if padding:
+        gallery = np.concatenate([gallery, np.repeat(gallery[-1:], padding, axis=0)])
+    gallery = gallery.reshape(-1, layout.chunk_size, gallery.shape[1])
+    if layout.mode == "argmin" and len(gallery) > 2 ** layout.index_bits:
+        raise ValueError(f"The gallery spans {len(gallery)} chunks, but the layout indexes {2 ** layout.index_bits}")
+    chunks = []
+    for index, chunk in enumerate(gallery):
+        last = index if layout.mode == "argmin" else _threshold_offset(layout, threshold)
+        chunks.append(circuit.encrypt(None, None, chunk, np.sum(chunk * chunk, axis=1), last, function_name="chunk")[2:])
+    return chunks
+
+
+def _values(result):
+    """The encrypted values of a chunk or merge result."""
+    return result if isinstance(result, tuple) else (result,)
+
+
+def fhe_gallery_decisions(circuit, encrypted_probe, gallery_chunks):
+    """
+    Run chunk on every gallery chunk, then merge the results pairwise, in gallery order,
+    until one is left (server side). Returns that single encrypted result.
+    """
+    results = [circuit.run(*encrypted_probe, *chunk, function_name="chunk") for chunk in gallery_chunks]
+    while len(results) > 1:
+        merged = [circuit.run(*_values(first), *_values(second), function_name="merge")
+                  for first, second in zip(results[0::2], results[1::2])]
+        results = merged + results[-1:] if len(results) % 2 else merged
+    return results[0]
+
+
+def decrypt_best_match(circuit, result, layout):
+    """
+    Decrypt an argmin result (client side). Returns (row, distance) of the nearest template;
+    of equally near ones, the lowest row within its chunk, then the lowest chunk.
+    """
+    key, index = circuit.decrypt(*result, function_name="merge")
+    distance, row = divmod(int(key), layout.chunk_size)
+    return int(index) * layout.chunk_size + row, distance
+
+
+def decrypt_match(circuit, result):
+    """Decrypt a threshold result (client side). Returns True if any template is within the threshold."""
+    return bool(circuit.decrypt(result, function_name="merge"))
@@ -0,0 +1,160 @@
+# src/gallery.py
+import threading
+from collections import OrderedDict
+
+from .database import get_fingerprint_store, deserialize_encrypted_features
+
+
+class GalleryReader:
+    """
+    Streams the enrolled gallery page by page and keeps the deserialized ciphertexts in an
+    LRU cache, so repeated passes over the gallery skip circuit.deserialize.
+    The cache is keyed by row id and bounded by the serialized size of its entries
+    (max_bytes). It registers itself on the store and drops the entries of every label
+    that is inserted or deleted.
+    """
+
+    def __init__(self, circuit, db_name="data/fingerprints.db", store=None, page_size=64,
+                 max_bytes=256 * 1024 * 1024):
+        self.circuit = circuit
+        self.store = store or get_fingerprint_store(db_name)
+        self.page_size = page_size
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()  # row id -> (label, size, deserialized value)
+        self.ids_by_label = {}
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped on every invalidation
+        self.store.add_listener(self.invalidate)
+
+    def _lookup(self, row_id):
+        """Return the cached value of a row and mark it as recently used, or None."""
+        with self.lock:
+            entry = self.cache.get(row_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(row_id)
+            self.hits += 1
+            return entry[2]
+
+    def _remember(self, row_id, label, size, value, generation):
+        """Cache a deserialized value, evicting the least recently used rows beyond max_bytes."""
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return  # the row may have been replaced while it was being deserialized
+            self._drop(row_id)
+            self.cache[row_id] = (label, size, value)
+            self.ids_by_label[label] = row_id
+            self.resident_bytes += size
+            while self.resident_bytes > self.max_bytes:
+                self._drop(next(iter(self.cache)))
+
+    def _drop(self, row_id):
+        """Remove one row from the cache. The caller holds the lock."""
+        entry = self.cache.pop(row_id, None)
+        if entry is not None:
+            self.resident_bytes -= entry[1]
+            if self.ids_by_label.get(entry[0]) == row_id:
+                del self.ids_by_label[entry[0]]
+
+    def invalidate(self, labels):
+        """Drop the cached values of the given labels (called by the store on every write)."""
+        with self.lock:
+            self.generation += 1
+            for label in labels:
+                row_id = self.ids_by_label.get(label)
+                if row_id is not None:
+                    self._drop(row_id)
+
+    def deserialize(self, row_id, label, encrypted_blob):
+        """Return the deserialized value of a row, using the cache when possible."""
+        generation = self.generation
+        value = self._lookup(row_id)
+        if value is None:
+            value = deserialize_encrypted_features(encrypted_blob, self.circuit)
+            self._remember(row_id, label, len(encrypted_blob), value, generation)
+        return value
+
+    def pages(self):
+        """
+        Yield the gallery as lists of (id, label, deserialized value), page_size rows at a time.
+        Only the rows missing from the cache are read from the database.
+        """
+        after_id = 0
+        while True:
+            rows = self.store.page(after_id, self.page_size)
+            if not rows:
+                return
+            generation = self.generation
+            values = {row_id: self._lookup(row_id) for row_id, _, _ in rows}
+            blobs = self.store.features_by_id(row_id for row_id, value in values.items() if value is None)
+            page = []
+            for row_id, label, _ in rows:
+                value = values[row_id]
+                if value is None:
+                    if row_id not in blobs:
+                        continue  # deleted since the page was read
+                    value = deserialize_encrypted_features(blobs[row_id], self.circuit)
+                    self._remember(row_id, label, len(blobs[row_id]), value, generation)
+                page.append((row_id, label, value))
+            yield page
+            after_id = rows[-1][0]
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page
+
+    def stats(self):
+        """Return the cache hit rate, resident bytes and entry count."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "resident_bytes": self.resident_bytes,
+                "entries": len(self.cache),
+            }
+
+    def close(self):
+        """Unregister from the store and clear the cache."""
+        self.store.remove_listener(self.invalidate)
+        with self.lock:
+            self.cache.clear()
+            self.ids_by_label.clear()
+            self.resident_bytes = 0
+
+
+# One reader per database, so every caller shares the same cache; it holds its circuit,
+# so a cached reader is only reused for that very circuit object
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def get_gallery_reader(circuit, db_name="data/fingerprints.db"):
+    """
+    Return the shared GalleryReader of a database, creating it on first use.
+    Asking for another circuit closes the database's previous reader (its cache and store
+    listener) and replaces it, so at most one reader per database stays resident.
+    """
+    with _readers_lock:
+        reader = _readers.get(db_name)
+        if reader is not None and reader.circuit is not circuit:
+            reader.close()
+            reader = None
+        if reader is None:
+            reader = _readers[db_name] = GalleryReader(circuit, db_name)
+        return reader
+
+
+def close_gallery_readers():
+    """Close every shared GalleryReader."""
+    with _readers_lock:
+        for reader in _readers.values():
+            reader.close()
+        _readers.clear()
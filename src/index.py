@@ -0,0 +1,138 @@
+# src/index.py
+import threading
+
+import numpy as np
+
+
+class QuantizedIndex:
+    """
+    In-memory 1:N identification index over clear quantized FingerCodes.
+    The gallery is a contiguous (capacity, dims) uint8 matrix that doubles when it fills up,
+    so inserts are amortized O(dims) and deletes move the last row into the freed slot.
+    Squared distances are computed as ||a||^2 - 2ab + ||b||^2 with one matrix multiply.
+    The products are accumulated in float32, which is exact while dims * max_value^2 < 2^24
+    (640 * 127^2 is about 10.3M), and the distances are then summed in int64.
+    """
+
+    def __init__(self, dims=640, max_value=127, capacity=1024):
+        if dims * max_value * max_value >= 2 ** 24:
+            raise ValueError(f"dims={dims} and max_value={max_value} overflow exact float32 products")
+        self.dims = dims
+        self.max_value = max_value
+        self.lock = threading.RLock()
+        self.vectors = np.zeros((capacity, dims), dtype=np.uint8)
+        # float32 mirror of the vectors, so queries do not convert the gallery every time
+        self.vectors32 = np.zeros((capacity, dims), dtype=np.float32)
+        self.norms = np.zeros(capacity, dtype=np.int64)
+        self.labels = []
+        self.rows = {}  # label -> row
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self.rows
+
+    def _check(self, vectors):
+        """Validate quantized vectors and return them as a 2D uint8 array."""
+        vectors = np.asarray(vectors)
+        if vectors.ndim == 1:
+            vectors = vectors[np.newaxis]
+        if vectors.shape[1] != self.dims:
+            raise ValueError(f"Expected vectors of {self.dims} features, got {vectors.shape[1]}")
+        if vectors.size and (vectors.min() < 0 or vectors.max() > self.max_value):
+            raise ValueError(f"Features must be quantized to 0..{self.max_value}")
+        return vectors.astype(np.uint8, copy=False)
+
+    def _grow(self, needed):
+        """Double the capacity until needed rows fit."""
+        # max(..., 1): an index created with capacity=0 would never grow by doubling
+        capacity = max(len(self.vectors), 1)
+        if needed <= len(self.vectors):
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ("vectors", "vectors32", "norms"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(self.labels)] = old[:len(self.labels)]
+            setattr(self, name, new)
+
+    def add_many(self, labels, vectors):
+        """Insert or replace the quantized vectors of several labels."""
+        vectors = self._check(vectors)
+        if len(labels) != len(vectors):
+            raise ValueError("labels and vectors must have the same length")
+        with self.lock:
+            self._grow(len(self.labels) + len(labels))
+            for label, vector in zip(labels, vectors):
+                row = self.rows.get(label)
+                if row is None:
+                    row = self.rows[label] = len(self.labels)
+                    self.labels.append(label)
+                self.vectors[row] = vector
+                self.vectors32[row] = vector
+                self.norms[row] = np.dot(vector.astype(np.int64), vector)
+
+    def add(self, label, vector):
+        """Insert or replace the quantized vector of a single label."""
+        self.add_many([label], [vector])
+
+    def remove_many(self, labels):
+        """Remove several labels by moving the last row into each freed slot. Returns the number removed."""
+        count = 0
+        with self.lock:
+            for label in labels:
+                row = self.rows.pop(label, None)
+                if row is None:
+                    continue
+                last = len(self.labels) - 1
+                if row != last:
+                    moved = self.labels[last]
+                    self.vectors[row] = self.vectors[last]
+                    self.vectors32[row] = self.vectors32[last]
+                    self.norms[row] = self.norms[last]
+                    self.labels[row] = moved
+                    self.rows[moved] = row
+                self.labels.pop()
+                count += 1
+        return count
+
+    def remove(self, label):
+        """Remove a single label. Returns True if it was enrolled."""
+        return self.remove_many([label]) == 1
+
+    def distances(self, probes):
+        """Return the (num_probes, N) int64 squared distances between probes and the gallery."""
+        probes = self._check(probes)
+        with self.lock:
+            size = len(self.labels)
+            products = probes.astype(np.float32) @ self.vectors32[:size].T
+            gallery_norms = self.norms[:size]
+        probe_norms = np.einsum("ij,ij->i", probes.astype(np.int64), probes.astype(np.int64))
+        return probe_norms[:, np.newaxis] - 2 * products.astype(np.int64) + gallery_norms
+
+    def search_batch(self, probes, k=5):
+        """
+        Return, for each probe, the k nearest labels as a list of (label, squared distance)
+        sorted by distance.
+        """
+        with self.lock:
+            labels = list(self.labels)
+            distances = self.distances(probes)
+        k = min(k, len(labels))
+        if k == 0:
+            return [[] for _ in range(len(distances))]
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1, kind="stable")
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_distances = np.take_along_axis(nearest_distances, order, axis=1)
+        return [
+            [(labels[row], int(distance)) for row, distance in zip(rows, row_distances)]
+            for rows, row_distances in zip(nearest, nearest_distances)
+        ]
+
+    def search(self, probe, k=5):
+        """Return the k nearest labels of a single probe as (label, squared distance) pairs."""
+        return self.search_batch(np.asarray(probe)[np.newaxis], k)[0]
@@ -0,0 +1,155 @@
+# src/metrics.py
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+
+# Progress messages of the pipeline go through this logger instead of print
+logger = logging.getLogger("bioauth")
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_enabled = os.environ.get("BIOAUTH_METRICS", "").lower() in ("1", "true", "yes")
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_null_span = contextlib.nullcontext()
+
+
+class Histogram:
+    """Latency histogram with fixed bucket bounds, plus the sum and count of observations."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (None if empty or beyond the last bound)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+def enable_metrics(enabled=True):
+    """Turn metric collection on or off for this process (BIOAUTH_METRICS=1 enables it at import)."""
+    global _enabled
+    _enabled = enabled
+
+
+def metrics_enabled():
+    return _enabled
+
+
+def increment(name, value=1):
+    """Add value to a counter."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """Record a latency in the histogram of a stage."""
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextlib.contextmanager
+def _span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def span(name):
+    """
+    Context manager timing a stage into the histogram of name.
+    When metrics are disabled it returns a shared no-op context manager.
+    """
+    return _span(name) if _enabled else _null_span
+
+
+def timed(name):
+    """Decorator timing every call of a function into the histogram of name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def reset_metrics():
+    """Clear every counter and histogram."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def snapshot():
+    """Return the counters and histograms as a plain dict (JSON serializable)."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "histograms": {
+                name: {
+                    "count": histogram.count,
+                    "sum_s": histogram.sum,
+                    "mean_s": histogram.sum / histogram.count if histogram.count else None,
+                    "p50_le_s": histogram.quantile(0.5),
+                    "p99_le_s": histogram.quantile(0.99),
+                    "buckets": dict(zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts)),
+                }
+                for name, histogram in _histograms.items()
+            },
+        }
+
+
+def prometheus_text(prefix="bioauth"):
+    """Return the counters and histograms in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for name, value in sorted(_counters.items()):
+            metric = f"{prefix}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, histogram in sorted(_histograms.items()):
+            metric = f"{prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {histogram.count}")
+    return "\n".join(lines) + "\n"
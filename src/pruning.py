@@ -0,0 +1,202 @@
+# src/pruning.py
+import threading
+
+import numpy as np
+
+from .index import QuantizedIndex
+from .secure_computation import (
+    encrypt_vector,
+    compute_encrypted_squared_distance,
+    mask_encrypted_distances,
+)
+
+
+class CoarseProjection:
+    """
+    Linear projection of quantized FingerCodes to a few dimensions.
+    The projected vector is the coarse key: it is stored at enrollment next to the template
+    and sent in clear with a probe, so coarse_dims is what the privacy review signs off on.
+    By default the projection is a seeded Gaussian matrix (Johnson-Lindenstrauss); fit()
+    replaces it with the top principal components of enrolled templates, which keeps far
+    more of the neighbour ordering of FingerCodes for the same number of dimensions.
+    Keys are stored as float16 and are only comparable with keys of the same projection.
+    """
+
+    def __init__(self, dims=640, coarse_dims=32, seed=0, max_value=127):
+        self.dims = dims
+        self.coarse_dims = coarse_dims
+        self.seed = seed
+        self.max_value = max_value
+        rng = np.random.default_rng(seed)
+        self.matrix = (rng.standard_normal((dims, coarse_dims)) / np.sqrt(coarse_dims)).astype(np.float32)
+        self.center = np.full(dims, max_value / 2, dtype=np.float32)
+
+    @classmethod
+    def fit(cls, vectors, coarse_dims=32, max_value=127):
+        """Build a projection on the top coarse_dims principal components of quantized vectors."""
+        vectors = np.asarray(vectors, dtype=np.float64)
+        projection = cls(vectors.shape[1], coarse_dims, seed=None, max_value=max_value)
+        center = vectors.mean(axis=0)
+        _, _, components = np.linalg.svd(vectors - center, full_matrices=False)
+        projection.matrix = components[:coarse_dims].T.astype(np.float32)
+        projection.center = center.astype(np.float32)
+        return projection
+
+    def save(self, path):
+        """Save the projection, so enrollment and queries use the same one."""
+        np.savez(path, matrix=self.matrix, center=self.center, max_value=self.max_value)
+
+    @classmethod
+    def load(cls, path):
+        """Load a projection written by save()."""
+        with np.load(path) as data:
+            matrix = data["matrix"]
+            projection = cls(matrix.shape[0], matrix.shape[1], seed=None, max_value=int(data["max_value"]))
+            projection.matrix = matrix
+            projection.center = data["center"]
+        return projection
+
+    def encode(self, vectors):
+        """Project one or several quantized vectors to (N, coarse_dims) float16 keys."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[np.newaxis]
+        # Centering keeps the float16 keys small; it does not change distances
+        return ((vectors - self.center) @ self.matrix).astype(np.float16)
+
+    def to_bytes(self, vector):
+        """Return the serialized coarse key of a single quantized vector."""
+        return self.encode(vector)[0].tobytes()
+
+    def from_bytes(self, key_bytes):
+        """Parse a serialized coarse key."""
+        key = np.frombuffer(key_bytes, dtype=np.float16)
+        if len(key) != self.coarse_dims:
+            raise ValueError(f"Expected a coarse key of {self.coarse_dims} values, got {len(key)}")
+        return key
+
+
+class CoarseIndex:
+    """
+    Shortlist index over coarse keys. Keys live in a contiguous float32 matrix that grows by
+    doubling, and deletes move the last row into the freed slot (as in QuantizedIndex).
+    """
+
+    def __init__(self, projection, capacity=1024):
+        self.projection = projection
+        self.lock = threading.RLock()
+        self.keys = np.zeros((capacity, projection.coarse_dims), dtype=np.float32)
+        self.labels = []
+        self.rows = {}  # label -> row
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add_keys(self, labels, keys):
+        """Insert or replace the coarse keys of several labels."""
+        keys = np.asarray(keys, dtype=np.float32).reshape(len(labels), self.projection.coarse_dims)
+        with self.lock:
+            needed = len(self.labels) + len(labels)
+            if needed > len(self.keys):
+                capacity = max(len(self.keys), 1)  # capacity=0 would never grow by doubling
+                while capacity < needed:
+                    capacity *= 2
+                grown = np.zeros((capacity, self.keys.shape[1]), dtype=np.float32)
+                grown[:len(self.labels)] = self.keys[:len(self.labels)]
+                self.keys = grown
+            for label, key in zip(labels, keys):
+                row = self.rows.get(label)
+                if row is None:
+                    row = self.rows[label] = len(self.labels)
+                    self.labels.append(label)
+                self.keys[row] = key
+
+    def add_many(self, labels, vectors):
+        """Project quantized vectors and insert their coarse keys."""
+        self.add_keys(labels, self.projection.encode(vectors))
+
+    def remove_many(self, labels):
+        """Remove several labels. Returns the number removed."""
+        count = 0
+        with self.lock:
+            for label in labels:
+                row = self.rows.pop(label, None)
+                if row is None:
+                    continue
+                last = len(self.labels) - 1
+                if row != last:
+                    moved = self.labels[last]
+                    self.keys[row] = self.keys[last]
+                    self.labels[row] = moved
+                    self.rows[moved] = row
+                self.labels.pop()
+                count += 1
+        return count
+
+    def shortlist(self, probe_key, size=32):
+        """Return the labels of the size templates whose coarse keys are closest to probe_key."""
+        probe_key = np.asarray(probe_key, dtype=np.float32).reshape(-1)
+        with self.lock:
+            keys = self.keys[:len(self.labels)]
+            distances = np.square(keys - probe_key).sum(axis=1)
+            size = min(size, len(distances))
+            if size == 0:
+                return []
+            nearest = np.argpartition(distances, size - 1)[:size]
+            nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+            return [self.labels[row] for row in nearest]
+
+
+def load_coarse_index(store, projection):
+    """Build a CoarseIndex from the coarse keys saved by enrollment in a FingerprintStore."""
+    coarse_index = CoarseIndex(projection)
+    rows = store.coarse_keys()
+    if rows:
+        labels, keys = zip(*rows)
+        coarse_index.add_keys(labels, np.stack([projection.from_bytes(key) for key in keys]))
+    return coarse_index
+
+
+def pruned_secure_distance_computation(client_vector, gallery, public_key, coarse_index,
+                                       shortlist_size=32, probe_key=None, randomizer_pool=None):
+    """
+    Two-stage version of secure_distance_computation.
+    The coarse key of the probe (computed here unless the client sent probe_key) picks a
+    shortlist of shortlist_size labels, and only those templates of gallery (a dict
+    label -> quantized vector) go through the encrypted distance and masking.
+    Returns the shortlisted labels and their masked encrypted distances, in the same order.
+    """
+    if probe_key is None:
+        probe_key = coarse_index.projection.encode(client_vector)[0]
+    shortlist = [label for label in coarse_index.shortlist(probe_key, shortlist_size) if label in gallery]
+
+    encrypted_client_vector = encrypt_vector(client_vector, public_key, randomizer_pool)
+    encrypted_distances = [
+        compute_encrypted_squared_distance(encrypted_client_vector, gallery[label], public_key)
+        for label in shortlist
+    ]
+    return shortlist, mask_encrypted_distances(encrypted_distances, public_key, randomizer_pool)
+
+
+def shortlist_recall(probes, labels, vectors, projection, shortlist_size=32, k=1):
+    """
+    Measure how often the coarse shortlist contains the true nearest templates.
+    For every probe, the exact top-k of a plaintext QuantizedIndex over (labels, vectors) is
+    compared with the shortlist; the encrypted distance ranks templates the same way, so this
+    is the recall of the two-stage search against a full search.
+    Returns the fraction of true top-k labels found in the shortlists.
+    """
+    exact = QuantizedIndex(dims=projection.dims, max_value=projection.max_value, capacity=max(1, len(labels)))
+    exact.add_many(labels, vectors)
+    coarse_index = CoarseIndex(projection, capacity=max(1, len(labels)))
+    coarse_index.add_many(labels, vectors)
+
+    probes = np.asarray(probes)
+    probe_keys = projection.encode(probes)
+    found = 0
+    total = 0
+    for neighbours, probe_key in zip(exact.search_batch(probes, k), probe_keys):
+        shortlist = set(coarse_index.shortlist(probe_key, shortlist_size))
+        found += sum(label in shortlist for label, _ in neighbours)
+        total += len(neighbours)
+    return found / total if total else 0.0
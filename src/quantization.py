@@ -0,0 +1,91 @@
+# src/quantization.py
+import hashlib
+import os
+
+import numpy as np
+
+
+class Quantizer:
+    """
+    Fixed affine quantizer of FingerCode features to bits-wide unsigned integers.
+    Its range is fitted once on an enrollment corpus (fit()), either for every dimension or
+    for all of them together, and then applied to every template and probe, so quantized
+    vectors share one scale and their distances are comparable. Values outside the fitted
+    range are clipped. Circuits and indexes built for the quantized vectors take
+    max_value = 2^bits - 1 (get_distance_circuit, QuantizedIndex, ...). version is a hash
+    of the fitted range and scale, recorded in the database the templates were enrolled into.
+    """
+
+    def __init__(self, low=0.0, high=255.0, bits=7):
+        if not 1 <= bits <= 8:
+            raise ValueError(f"bits must be between 1 and 8, got {bits}")
+        self.bits = bits
+        self.max_value = 2 ** bits - 1
+        self.low = np.asarray(low, dtype=np.float32)
+        self.high = np.asarray(high, dtype=np.float32)
+        # A constant dimension would divide by zero; it quantizes to 0 instead
+        self.scale = (self.max_value / np.maximum(self.high - self.low, np.float32(1e-6))).astype(np.float32)
+
+    @property
+    def version(self):
+        digest = hashlib.sha256(str(self.bits).encode())
+        for array in (self.low, self.high, self.scale):
+            digest.update(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+        return f"q{self.bits}-{digest.hexdigest()[:12]}"
+
+    @classmethod
+    def fit(cls, features, bits=7, per_dimension=True, low_percentile=1.0, high_percentile=99.0):
+        """
+        Fit the range on (N, dims) float features: the low_percentile and high_percentile of
+        every dimension (per_dimension) or of all values together. Features reduced by a
+        DimensionReducer must use per_dimension=False (see src.reduction), so every component
+        keeps its relative scale.
+        """
+        features = np.asarray(features, dtype=np.float32)
+        axis = 0 if per_dimension else None
+        low = np.percentile(features, low_percentile, axis=axis)
+        high = np.percentile(features, high_percentile, axis=axis)
+        return cls(low, high, bits)
+
+    def quantize(self, features):
+        """Quantize one (dims,) vector or an (N, dims) batch to uint8 values in [0, max_value]."""
+        features = np.asarray(features, dtype=np.float32)
+        quantized = (features - self.low) * self.scale
+        np.rint(quantized, out=quantized)
+        np.clip(quantized, 0, self.max_value, out=quantized)
+        return quantized.astype(np.uint8)
+
+    def save(self, path):
+        """Save the quantizer, so enrollment and queries use the same one."""
+        np.savez(path, low=self.low, high=self.high, scale=self.scale, bits=self.bits)
+
+    @classmethod
+    def load(cls, path):
+        """Load a quantizer written by save()."""
+        with np.load(path) as data:
+            quantizer = cls(data["low"], data["high"], int(data["bits"]))
+            # The saved scale, so a reloaded quantizer rounds exactly like the fitted one
+            quantizer.scale = data["scale"]
+        return quantizer
+
+
+def quantizer_path(db_name):
+    """Path of the quantizer saved next to a database."""
+    return f"{db_name}.quantizer.npz"
+
+
+def load_quantizer(db_name, expected_version=None):
+    """
+    Load the quantizer saved next to a database, or None if the database has none.
+    expected_version is the version the database recorded at enrollment; a quantizer file
+    that does not match it raises ValueError.
+    """
+    path = quantizer_path(db_name)
+    if not os.path.exists(path):
+        if expected_version is not None:
+            raise ValueError(f"{db_name} was enrolled with quantizer {expected_version}, but {path} is missing")
+        return None
+    quantizer = Quantizer.load(path)
+    if expected_version is not None and quantizer.version != expected_version:
+        raise ValueError(f"{path} is {quantizer.version}, but {db_name} was enrolled with {expected_version}")
+    return quantizer
@@ -0,0 +1,110 @@
+# src/reduction.py
+import hashlib
+import os
+
+import numpy as np
+
+METHODS = ("pca", "whiten", "select")
+
+
+class DimensionReducer:
+    """
+    Linear map of FingerCode features to fewer dimensions, applied between extraction and
+    quantization, so every encrypted vector (Concrete template, Paillier probe) is shorter.
+    Methods, all fitted on enrollment features with fit():
+        pca     projection on the top principal components
+        whiten  the same, with every component scaled to unit variance
+        select  the dims input features with the best between-subject to within-subject
+                variance ratio (the highest variance without subject labels)
+    transform() computes (features - center) @ matrix. version is a hash of the fitted
+    parameters: a database records it at enrollment, and probes must use the same reducer.
+    Quantize reduced features with one global, unclipped range (Quantizer.fit with
+    per_dimension=False, 0 and 100 percentiles): per-dimension ranges rescale the components
+    and clipping cuts the leading ones, and both distort the distances pca preserves.
+    """
+
+    def __init__(self, center, matrix, method="pca"):
+        if method not in METHODS:
+            raise ValueError(f"Unknown reduction method {method!r}, expected one of {METHODS}")
+        self.method = method
+        self.center = np.asarray(center, dtype=np.float32)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.input_dims, self.dims = self.matrix.shape
+
+    @property
+    def version(self):
+        digest = hashlib.sha256(self.method.encode())
+        digest.update(self.center.tobytes())
+        digest.update(self.matrix.tobytes())
+        return f"{self.method}-{self.dims}-{digest.hexdigest()[:12]}"
+
+    @classmethod
+    def fit(cls, features, dims=128, method="pca", subjects=None):
+        """Fit a reducer to dims dimensions on (N, input_dims) float features."""
+        features = np.asarray(features, dtype=np.float64)
+        if not 0 < dims <= features.shape[1]:
+            raise ValueError(f"dims must be between 1 and {features.shape[1]}, got {dims}")
+        if method == "select":
+            if subjects is None:
+                scores = features.var(axis=0)
+            else:
+                _, groups = np.unique(np.asarray(subjects), return_inverse=True)
+                counts = np.bincount(groups).astype(np.float64)
+                means = np.zeros((len(counts), features.shape[1]))
+                np.add.at(means, groups, features)
+                means /= counts[:, np.newaxis]
+                within = ((features - means[groups]) ** 2).sum(axis=0)
+                between = (counts[:, np.newaxis] * (means - features.mean(axis=0)) ** 2).sum(axis=0)
+                scores = between / np.maximum(within, 1e-12)
+            selected = np.sort(np.argsort(scores, kind="stable")[::-1][:dims])
+            matrix = np.zeros((features.shape[1], dims))
+            matrix[selected, np.arange(dims)] = 1
+            # Selected features keep their own values, so they quantize like unreduced ones
+            return cls(np.zeros(features.shape[1]), matrix, method)
+
+        center = features.mean(axis=0)
+        _, singular_values, components = np.linalg.svd(features - center, full_matrices=False)
+        matrix = components[:dims].T
+        if method == "whiten":
+            deviations = singular_values[:dims] / np.sqrt(max(len(features) - 1, 1))
+            matrix = matrix / np.maximum(deviations, 1e-12)
+        return cls(center, matrix, method)
+
+    def transform(self, features):
+        """Reduce one (input_dims,) vector or an (N, input_dims) batch of features."""
+        features = np.asarray(features, dtype=np.float32)
+        if features.shape[-1] != self.input_dims:
+            raise ValueError(f"Expected {self.input_dims} features, got {features.shape[-1]}")
+        return (features - self.center) @ self.matrix
+
+    def save(self, path):
+        """Save the reducer, so enrollment and queries use the same one."""
+        np.savez(path, center=self.center, matrix=self.matrix, method=self.method)
+
+    @classmethod
+    def load(cls, path):
+        """Load a reducer written by save()."""
+        with np.load(path) as data:
+            return cls(data["center"], data["matrix"], str(data["method"]))
+
+
+def reducer_path(db_name):
+    """Path of the reducer saved next to a database."""
+    return f"{db_name}.reducer.npz"
+
+
+def load_reducer(db_name, expected_version=None):
+    """
+    Load the reducer saved next to a database, or None if the database has none.
+    expected_version is the version the database recorded at enrollment; a reducer file
+    that does not match it raises ValueError instead of silently producing wrong probes.
+    """
+    path = reducer_path(db_name)
+    if not os.path.exists(path):
+        if expected_version is not None:
+            raise ValueError(f"{db_name} was enrolled with reducer {expected_version}, but {path} is missing")
+        return None
+    reducer = DimensionReducer.load(path)
+    if expected_version is not None and reducer.version != expected_version:
+        raise ValueError(f"{path} is {reducer.version}, but {db_name} was enrolled with {expected_version}")
+    return reducer
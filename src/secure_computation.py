@@ -1,5 +1,14 @@
+import multiprocessing
+import os
+import random
+import struct
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from phe import paillier
+from phe.util import invert, mulmod, powmod
+from .metrics import timed
 
 #Homomorphic encryption
 def generate_paillier_keypair():
@@ -7,14 +16,174 @@ def generate_paillier_keypair():
     public_key, private_key = paillier.generate_paillier_keypair()
     return public_key, private_key
 
-def encrypt_vector(vector, public_key):
-    """Encrypt a vector using Paillier encryption."""
+def _compute_randomizers(n, count):
+    """Compute count Paillier randomizers r^n mod n^2 for random r < n."""
+    nsquare = n * n
+    generator = random.SystemRandom()
+    return [powmod(generator.randrange(1, n), n, nsquare) for _ in range(count)]
+
+
+class RandomizerPool:
+    """
+    Pool of precomputed Paillier randomizers r^n mod n^2 for one public key.
+    A background thread refills the pool whenever it drops below the low-water mark, so an
+    encryption on the request path only costs a modular multiplication. With processes > 0
+    the randomizers are computed in a process pool instead of the refill thread.
+    """
+
+    def __init__(self, public_key, size=4096, low_water=1024, batch_size=64, processes=0):
+        self.public_key = public_key
+        self.size = size
+        self.low_water = low_water
+        self.batch_size = batch_size
+        self.processes = processes
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self._randomizers = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._closed = False
+        # Spawned, not forked: the first submit comes from the refill thread while other threads may hold locks
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        ) if processes else None
+        self._thread = threading.Thread(target=self._refill_loop, daemon=True)
+        self._thread.start()
+        self._refill.set()
+
+    def _refill_loop(self):
+        """Top the pool up to its size every time a refill is requested."""
+        while True:
+            self._refill.wait()
+            if self._closed:
+                return
+            self._refill.clear()
+            while not self._closed and len(self._randomizers) < self.size:
+                count = min(self.batch_size, self.size - len(self._randomizers))
+                if self._executor is not None:
+                    per_process = -(-count // self.processes)
+                    jobs = [self._executor.submit(_compute_randomizers, self.public_key.n, per_process)
+                            for _ in range(self.processes)]
+                    randomizers = [r for job in jobs for r in job.result()]
+                else:
+                    randomizers = _compute_randomizers(self.public_key.n, count)
+                with self._lock:
+                    self._randomizers.extend(randomizers)
+                    self.generated += len(randomizers)
+
+    def get(self):
+        """Take a randomizer from the pool, computing one inline if the pool is empty."""
+        with self._lock:
+            if self._randomizers:
+                randomizer = self._randomizers.popleft()
+                self.hits += 1
+            else:
+                randomizer = None
+                self.misses += 1
+            if len(self._randomizers) < self.low_water:
+                self._refill.set()
+        if randomizer is None:
+            randomizer = _compute_randomizers(self.public_key.n, 1)[0]
+        return randomizer
+
+    def encrypt(self, value):
+        """Paillier-encrypt an int or float using a precomputed randomizer."""
+        public_key = self.public_key
+        encoding = paillier.EncodedNumber.encode(public_key, value)
+        # r_value=1 skips phe's own obfuscation, the pooled r^n takes its place
+        nude_ciphertext = public_key.raw_encrypt(encoding.encoding, r_value=1)
+        ciphertext = mulmod(nude_ciphertext, self.get(), public_key.nsquare)
+        # Like public_key.encrypt with an explicit r_value, the number is not flagged as obfuscated:
+        # ciphertext(be_secure=True) would multiply in one more r^n, which is redundant but safe.
+        # The distance kernels read ciphertext(False), so the pooled r^n is the only one paid for.
+        return paillier.EncryptedNumber(public_key, ciphertext, encoding.exponent)
+
+    def stats(self):
+        """Return pool hits, misses, hit rate and the number of randomizers available."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "available": len(self._randomizers),
+                "generated": self.generated,
+            }
+
+    def close(self):
+        """Stop the refill thread and the worker processes."""
+        self._closed = True
+        self._refill.set()
+        self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@timed("paillier_encrypt")
+def encrypt_vector(vector, public_key, randomizer_pool=None):
+    """Encrypt a vector using Paillier encryption, optionally with precomputed randomizers."""
     # Convert each element to a Python int before encryption
+    if randomizer_pool is not None:
+        return [randomizer_pool.encrypt(int(x)) for x in vector]
     encrypted_vector = [public_key.encrypt(int(x)) for x in vector]
     return encrypted_vector
 
 #Euclidean Distance
+def _multi_exponentiation(ciphertexts, exponents, modulus):
+    """
+    Compute the product of ciphertexts[i] ** exponents[i] mod modulus for non-negative exponents.
+    The ciphertexts sharing a bit of their exponent are multiplied together first, so the
+    whole product costs one squaring per exponent bit plus one multiplication per set bit.
+    """
+    result = 1
+    for bit in reversed(range(int(max(exponents, default=0)).bit_length())):
+        result = mulmod(result, result, modulus)
+        for ciphertext, exponent in zip(ciphertexts, exponents):
+            if (exponent >> bit) & 1:
+                result = mulmod(result, ciphertext, modulus)
+    return result
+
+
+@timed("paillier_distance")
 def compute_encrypted_squared_distance(encrypted_vector, db_vector, public_key):
+    """
+    Compute the squared Euclidean distance between the encrypted vector and a database vector.
+    The -2 * v1[i] * v2[i] terms are folded into one multi-exponentiation and the plaintext sum
+    of v2[i]^2 is added once as an encoded constant, instead of one encryption per element.
+    """
+    assert len(encrypted_vector) == len(db_vector), "Vectors must be the same length"
+
+    db_vector = np.asarray(db_vector)
+    probe_exponents = {enc_val.exponent for enc_val in encrypted_vector}
+    # Float templates or mixed encodings keep the element-by-element computation
+    if len(probe_exponents) > 1 or not np.all(np.mod(db_vector, 1) == 0):
+        return _compute_encrypted_squared_distance_loop(encrypted_vector, db_vector, public_key)
+
+    db_values = [int(db_val) for db_val in db_vector]
+    ciphertexts = [enc_val.ciphertext(False) for enc_val in encrypted_vector]
+    nsquare = public_key.nsquare
+
+    # E(sum v1[i] * v2[i]) split by the sign of v2[i], so every exponent stays small and positive
+    positive = _multi_exponentiation(ciphertexts, [max(db_val, 0) for db_val in db_values], nsquare)
+    negative = _multi_exponentiation(ciphertexts, [max(-db_val, 0) for db_val in db_values], nsquare)
+    # E(-2 * sum v1[i] * v2[i]) = (E(sum of negative terms) / E(sum of positive terms)) ** 2
+    cross_term = mulmod(negative, invert(positive, nsquare), nsquare)
+    cross_term = mulmod(cross_term, cross_term, nsquare)
+
+    encrypted_distance = paillier.EncryptedNumber(public_key, cross_term, probe_exponents.pop() if probe_exponents else 0)
+    # Add the plaintext sum of v2[i]^2 once
+    return encrypted_distance + sum(db_val * db_val for db_val in db_values)
+
+
+#Euclidean Distance (reference implementation, one encryption per element)
+def _compute_encrypted_squared_distance_loop(encrypted_vector, db_vector, public_key):
     """Compute the squared Euclidean distance between the encrypted vector and a database vector."""
     assert len(encrypted_vector) == len(db_vector), "Vectors must be the same length"
     
@@ -36,19 +205,21 @@ def compute_encrypted_squared_distance(encrypted_vector, db_vector, public_key):
     return encrypted_distance
 
 #Masking and secure distance computation
-def mask_encrypted_distances(encrypted_distances, public_key):
+@timed("paillier_mask")
+def mask_encrypted_distances(encrypted_distances, public_key, randomizer_pool=None):
     """Mask the encrypted distances with random values."""
+    encrypt = randomizer_pool.encrypt if randomizer_pool is not None else public_key.encrypt
     masked_encrypted_distances = []
     for enc_dist in encrypted_distances:
         mask = np.random.randint(1, 100000)
-        masked_enc_dist = enc_dist + public_key.encrypt(mask)
+        masked_enc_dist = enc_dist + encrypt(mask)
         masked_encrypted_distances.append((masked_enc_dist, mask))
     return masked_encrypted_distances
 
-def secure_distance_computation(client_vector, database, public_key):
+def secure_distance_computation(client_vector, database, public_key, randomizer_pool=None):
     """Perform secure distance computation between a client's encrypted vector and a database."""
     # Encrypt the client's feature vector
-    encrypted_client_vector = encrypt_vector(client_vector, public_key)
+    encrypted_client_vector = encrypt_vector(client_vector, public_key, randomizer_pool)
     
     # Compute the encrypted squared distances
     encrypted_distances = []
@@ -57,10 +228,11 @@ def secure_distance_computation(client_vector, database, public_key):
         encrypted_distances.append(encrypted_distance)
     
     # Mask the encrypted distances
-    masked_encrypted_distances = mask_encrypted_distances(encrypted_distances, public_key)
+    masked_encrypted_distances = mask_encrypted_distances(encrypted_distances, public_key, randomizer_pool)
     
     return masked_encrypted_distances
 
+@timed("paillier_decrypt")
 def decrypt_and_unmask_distances(masked_encrypted_distances, private_key):
     """Decrypt the masked encrypted distances and remove the masking values."""
     decrypted_distances = []
@@ -71,3 +243,374 @@ def decrypt_and_unmask_distances(masked_encrypted_distances, private_key):
         unmasked_distance = decrypted_value - mask
         decrypted_distances.append(unmasked_distance)
     return decrypted_distances
+
+
+#Packed encoding: many vector elements per Paillier plaintext
+PackedLayout = namedtuple("PackedLayout", ["slot_bits", "slots", "dims", "max_value", "mask_bound", "blinding_bits"])
+
+
+def packed_layout(public_key, dims=640, max_value=127, mask_bound=100000, blinding_bits=40):
+    """
+    Choose the slot width and the number of slots per ciphertext for packed vectors.
+    A slot must hold the largest squared-distance accumulation without carrying into its
+    neighbour, plus blinding_bits of random padding that hides the slots the client should
+    not read. The product of a packed probe and a packed template spans 2 * slots - 1 slots,
+    which must fit in the plaintext space of the key.
+    """
+    # ||y||^2 + 2 * x.(max - y) + mask bounds the distance slot and every other slot
+    accumulation_bits = (3 * dims * max_value * max_value + mask_bound).bit_length()
+    slot_bits = accumulation_bits + blinding_bits + 1
+    slots = ((public_key.max_int.bit_length() - 1) // slot_bits + 1) // 2
+    if slots < 1:
+        raise ValueError("Paillier key is too small for the packed layout")
+    return PackedLayout(slot_bits, slots, dims, max_value, mask_bound, blinding_bits)
+
+
+def _packable_values(vector, layout):
+    """Convert a vector to Python ints, checking it fits the packed layout."""
+    values = [int(x) for x in vector]
+    if len(values) != layout.dims or min(values) < 0 or max(values) > layout.max_value:
+        raise ValueError(f"Packed vectors must hold {layout.dims} ints in [0, {layout.max_value}]")
+    return values
+
+
+def pack_vector(vector, layout):
+    """Pack a vector of ints in [0, max_value] into one integer per `slots` elements."""
+    values = _packable_values(vector, layout)
+    packed = []
+    for start in range(0, layout.dims, layout.slots):
+        plaintext = 0
+        for x in reversed(values[start:start + layout.slots]):
+            plaintext = (plaintext << layout.slot_bits) + x
+        packed.append(plaintext)
+    return packed
+
+
+@timed("paillier_encrypt_packed")
+def encrypt_vector_packed(vector, public_key, layout, randomizer_pool=None):
+    """Encrypt a vector with `slots` elements per Paillier ciphertext."""
+    encrypt = randomizer_pool.encrypt if randomizer_pool is not None else public_key.encrypt
+    return [encrypt(plaintext) for plaintext in pack_vector(vector, layout)]
+
+
+def _packed_template_scalars(db_vector, layout):
+    """
+    Return the per-ciphertext scalars of a template and its squared norm.
+    Each scalar packs 2 * (max_value - v2[i]) in reversed slot order, so multiplying a packed
+    probe by it leaves sum v1[i] * 2 * (max_value - v2[i]) in the middle slot (slots - 1).
+    """
+    values = _packable_values(db_vector, layout)
+    scalars = []
+    for start in range(0, layout.dims, layout.slots):
+        chunk = values[start:start + layout.slots]
+        scalar = 0
+        for offset in range(layout.slots):
+            weight = 2 * (layout.max_value - chunk[offset]) if offset < len(chunk) else 0
+            scalar += weight << (layout.slot_bits * (layout.slots - 1 - offset))
+        scalars.append(scalar)
+    return scalars, sum(db_val * db_val for db_val in values)
+
+
+@timed("paillier_distance_packed")
+def compute_encrypted_squared_distance_packed(encrypted_packed_vector, db_vector, public_key, layout):
+    """
+    Compute the squared Euclidean distance between a packed encrypted vector and a database vector.
+    The middle slot of the result holds ||v2||^2 - 2 * v1.v2 + 2 * max_value * sum(v1); the client
+    knows sum(v1) and removes that offset after decryption.
+    """
+    scalars, squared_norm = _packed_template_scalars(db_vector, layout)
+    assert len(encrypted_packed_vector) == len(scalars), "Vectors must use the same packed layout"
+
+    ciphertexts = [enc_val.ciphertext(False) for enc_val in encrypted_packed_vector]
+    cross_term = _multi_exponentiation(ciphertexts, scalars, public_key.nsquare)
+    encrypted_distance = paillier.EncryptedNumber(public_key, cross_term, 0)
+    return encrypted_distance + (squared_norm << (layout.slot_bits * (layout.slots - 1)))
+
+
+@timed("paillier_mask_packed")
+def mask_encrypted_distances_packed(encrypted_distances, public_key, layout, randomizer_pool=None):
+    """
+    Mask the distance slot of packed encrypted distances with random values.
+    Every other slot is filled with random padding, so the client only learns the distance.
+    """
+    encrypt = randomizer_pool.encrypt if randomizer_pool is not None else public_key.encrypt
+    generator = random.SystemRandom()
+    middle = layout.slot_bits * (layout.slots - 1)
+    masked_encrypted_distances = []
+    for enc_dist in encrypted_distances:
+        mask = np.random.randint(1, layout.mask_bound)
+        blinding = 0
+        if layout.blinding_bits:
+            # Padding below 2 ** (slot_bits - 1) cannot carry into the next slot
+            for slot in range(2 * layout.slots - 1):
+                if slot != layout.slots - 1:
+                    blinding += generator.getrandbits(layout.slot_bits - 1) << (layout.slot_bits * slot)
+        masked_enc_dist = enc_dist + encrypt((mask << middle) + blinding)
+        masked_encrypted_distances.append((masked_enc_dist, mask))
+    return masked_encrypted_distances
+
+
+def secure_distance_computation_packed(client_vector, database, public_key, layout=None, randomizer_pool=None):
+    """Perform secure distance computation with packed ciphertexts. Returns the masked distances and the layout."""
+    if layout is None:
+        layout = packed_layout(public_key, dims=len(client_vector))
+    encrypted_client_vector = encrypt_vector_packed(client_vector, public_key, layout, randomizer_pool)
+
+    encrypted_distances = []
+    for db_vector in database:
+        encrypted_distance = compute_encrypted_squared_distance_packed(encrypted_client_vector, db_vector, public_key, layout)
+        encrypted_distances.append(encrypted_distance)
+
+    masked_encrypted_distances = mask_encrypted_distances_packed(encrypted_distances, public_key, layout, randomizer_pool)
+    return masked_encrypted_distances, layout
+
+
+@timed("paillier_decrypt_packed")
+def decrypt_and_unmask_distances_packed(masked_encrypted_distances, private_key, layout, client_vector):
+    """Decrypt packed masked distances, read the distance slot and remove the mask and offset."""
+    offset = 2 * layout.max_value * sum(int(x) for x in client_vector)
+    middle = layout.slot_bits * (layout.slots - 1)
+    slot_mask = (1 << layout.slot_bits) - 1
+    decrypted_distances = []
+    for masked_enc_dist, mask in masked_encrypted_distances:
+        decrypted_value = private_key.decrypt(masked_enc_dist)
+        distance_slot = (decrypted_value >> middle) & slot_mask
+        decrypted_distances.append(distance_slot - mask - offset)
+    return decrypted_distances
+
+
+# Private key of a decryption worker process, set up once by _init_decrypt_worker
+_decrypt_key = None
+
+
+def _init_decrypt_worker(n, p, q):
+    """Rebuild the private key from its primes once per worker process."""
+    global _decrypt_key
+    _decrypt_key = paillier.PaillierPrivateKey(paillier.PaillierPublicKey(n), p, q)
+
+
+def _decrypt_chunk(ciphertexts, masks, slot=None, private_key=None):
+    """
+    CRT-decrypt raw ciphertexts and remove their masks.
+    Without slot the plaintexts are decoded like phe's EncodedNumber (the top third of Z_n
+    holds negative numbers); with slot=(shift, slot_mask) the distance slot of a packed
+    plaintext is read instead.
+    """
+    private_key = private_key or _decrypt_key
+    n = private_key.public_key.n
+    max_int = private_key.public_key.max_int
+    values = []
+    for ciphertext, mask in zip(ciphertexts, masks):
+        value = private_key.raw_decrypt(ciphertext)
+        if slot is not None:
+            value = (value >> slot[0]) & slot[1]
+        elif value >= n - max_int:
+            value -= n
+        elif value > max_int:
+            raise OverflowError("Overflow detected in decrypted number")
+        values.append(value - mask)
+    return values
+
+
+class DecryptionPool:
+    """
+    Process pool for batch decryption with one private key.
+    Each worker rebuilds the key from (n, p, q) once at startup, so a batch only ships raw
+    ciphertext integers and masks. With processes=0 the work runs in the calling process.
+    """
+
+    def __init__(self, private_key, processes=None, chunk_size=64):
+        self.private_key = private_key
+        self.chunk_size = chunk_size
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self._executor = None
+        if self.processes:
+            public_key = private_key.public_key
+            # Spawned, not forked: the service and enrollment call this from threaded processes
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_decrypt_worker,
+                initargs=(public_key.n, private_key.p, private_key.q),
+            )
+
+    def decrypt(self, ciphertexts, masks, slot=None):
+        """Decrypt and unmask raw ciphertexts, returning a list of Python ints."""
+        if self._executor is None:
+            return _decrypt_chunk(ciphertexts, masks, slot, self.private_key)
+        jobs = [
+            self._executor.submit(_decrypt_chunk, ciphertexts[start:start + self.chunk_size],
+                                  masks[start:start + self.chunk_size], slot)
+            for start in range(0, len(ciphertexts), self.chunk_size)
+        ]
+        return [value for job in jobs for value in job.result()]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@timed("paillier_decrypt_batch")
+def decrypt_and_unmask_distances_batch(masked_encrypted_distances, private_key, k=None, pool=None,
+                                       layout=None, client_vector=None):
+    """
+    Batch version of decrypt_and_unmask_distances (and of the packed variant when layout
+    and client_vector are given).
+    Decrypts with the CRT path on raw ciphertexts, in a DecryptionPool if one is passed, and
+    returns the unmasked distances as an int64 array. With k, also returns the indices of
+    the k smallest distances, sorted.
+    """
+    if not masked_encrypted_distances:
+        distances = np.empty(0, dtype=np.int64)
+        return (distances, np.empty(0, dtype=np.int64)) if k is not None else distances
+    if layout is None and any(enc_dist.exponent != 0 for enc_dist, _ in masked_encrypted_distances):
+        # Float distances carry a scaling exponent; use phe's decoding for them
+        distances = np.asarray(decrypt_and_unmask_distances(masked_encrypted_distances, private_key))
+    else:
+        ciphertexts = [enc_dist.ciphertext(be_secure=False) for enc_dist, _ in masked_encrypted_distances]
+        masks = [int(mask) for _, mask in masked_encrypted_distances]
+        slot = None
+        if layout is not None:
+            slot = (layout.slot_bits * (layout.slots - 1), (1 << layout.slot_bits) - 1)
+        if pool is not None:
+            values = pool.decrypt(ciphertexts, masks, slot)
+        else:
+            values = _decrypt_chunk(ciphertexts, masks, slot, private_key)
+        distances = np.array(values, dtype=np.int64)
+        if layout is not None:
+            distances -= 2 * layout.max_value * int(np.sum(np.asarray(client_vector, dtype=np.int64)))
+    if k is None:
+        return distances
+    k = min(k, len(distances))
+    nearest = np.argpartition(distances, k - 1)[:k]
+    return distances, nearest[np.argsort(distances[nearest], kind="stable")]
+
+
+#Precomputed template encodings: the probe-independent half of the distance kernel
+# Header of an encoded template: max_value, dims and squared norm, followed by the values
+ENCODING_HEADER = struct.Struct("<HHQ")
+
+
+def encode_template(db_vector, max_value=127):
+    """
+    Encode the probe-independent part of compute_encrypted_squared_distance for one
+    quantized template: its values as one byte each, which are the exponents of the
+    multi-exponentiation, and its squared norm. Returns the bytes stored in the encoding
+    column of the store. The encoding is the template in clear, like the plaintext vectors
+    Paillier matching already runs on; keep it wherever those are kept.
+    """
+    if not 0 < max_value <= 255:
+        raise ValueError(f"Encoded templates need max_value in 1..255, got {max_value}")
+    values = np.asarray(db_vector)
+    if values.ndim != 1 or not np.all(np.mod(values, 1) == 0) or (values.size and (values.min() < 0 or values.max() > max_value)):
+        raise ValueError(f"Encoded templates must hold ints in [0, {max_value}]")
+    values = values.astype(np.int64)
+    return ENCODING_HEADER.pack(max_value, len(values), int(values @ values)) + values.astype(np.uint8).tobytes()
+
+
+def _bucket_exponentiation(ciphertexts, order, starts, modulus):
+    """
+    Compute the product of ciphertexts[i] ** v[i] mod modulus for exponents v[i] in [0, max_value].
+    order lists the indices by increasing exponent and starts[e] is the position of the first
+    index with exponent e. The ciphertexts of each exponent are multiplied into a bucket,
+    and the running product of the buckets from max_value down to e is multiplied into the
+    result once per e, so bucket e ends up raised to e. That is one multiplication per
+    nonzero element plus two per exponent value, instead of one per set bit.
+    """
+    result = 1
+    running = 1
+    for exponent in range(len(starts) - 2, 0, -1):
+        for index in order[starts[exponent]:starts[exponent + 1]].tolist():
+            running = mulmod(running, ciphertexts[index], modulus)
+        if running != 1:
+            result = mulmod(result, running, modulus)
+    return result
+
+
+class GalleryEncoding:
+    """
+    Array-backed gallery of encoded templates (see encode_template).
+    The values of every template are one (N, dims) uint8 array and the squared norms one
+    int64 array. On load, each template's indices are sorted by value into (N, dims)
+    uint16 orders with (N, max_value + 2) bucket starts, so a query only multiplies
+    ciphertexts (see _bucket_exponentiation).
+    """
+
+    def __init__(self, labels, values, norms, max_value=127):
+        self.labels = list(labels)
+        self.values = np.asarray(values, dtype=np.uint8)
+        self.norms = np.asarray(norms, dtype=np.int64)
+        self.max_value = max_value
+        if not len(self.labels) == len(self.values) == len(self.norms):
+            raise ValueError("labels, values and norms must have the same length")
+        self.dims = self.values.shape[1] if self.values.ndim == 2 else 0
+        self.order = np.argsort(self.values, axis=1, kind="stable").astype(np.uint16)
+        counts = np.zeros((len(self.values), max_value + 1), dtype=np.int64)
+        np.add.at(counts, (np.arange(len(self.values))[:, np.newaxis], self.values), 1)
+        self.starts = np.concatenate([np.zeros((len(self.values), 1), dtype=np.int64), np.cumsum(counts, axis=1)],
+                                     axis=1).astype(np.uint16)
+
+    @classmethod
+    def from_blobs(cls, rows):
+        """Build the gallery from (label, encoding) rows, e.g. FingerprintStore.encodings()."""
+        labels, values, norms = [], [], []
+        shape = None
+        for label, blob in rows:
+            max_value, dims, norm = ENCODING_HEADER.unpack_from(blob)
+            if shape is None:
+                shape = (max_value, dims)
+            elif (max_value, dims) != shape:
+                raise ValueError(f"Encoding of {label} is {dims} values in 0..{max_value}, "
+                                 f"expected {shape[1]} values in 0..{shape[0]}")
+            labels.append(label)
+            values.append(np.frombuffer(blob, dtype=np.uint8, count=dims, offset=ENCODING_HEADER.size))
+            norms.append(norm)
+        if shape is None:
+            return cls([], np.zeros((0, 0), dtype=np.uint8), [])
+        return cls(labels, np.stack(values), norms, shape[0])
+
+    @classmethod
+    def from_vectors(cls, labels, vectors, max_value=127):
+        """Encode quantized templates directly."""
+        return cls.from_blobs((label, encode_template(vector, max_value)) for label, vector in zip(labels, vectors))
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.norms.nbytes + self.order.nbytes + self.starts.nbytes
+
+    @timed("paillier_distance_encoded")
+    def encrypted_distances(self, encrypted_vector, public_key):
+        """
+        compute_encrypted_squared_distance of the encrypted vector and every template.
+        ||v2||^2 is added as the ciphertext g^||v2||^2 = 1 + n * ||v2||^2 mod n^2, so no
+        plaintext is encoded on the query path.
+        """
+        assert len(encrypted_vector) == self.dims, "Vectors must be the same length"
+        if any(enc_val.exponent != 0 for enc_val in encrypted_vector):
+            raise ValueError("Encoded templates need a probe of ints (encrypt_vector of a quantized vector)")
+        ciphertexts = [enc_val.ciphertext(False) for enc_val in encrypted_vector]
+        n, nsquare = public_key.n, public_key.nsquare
+        encrypted_distances = []
+        for order, starts, norm in zip(self.order, self.starts, self.norms.tolist()):
+            # E(-2 * sum v1[i] * v2[i]) = E(sum v1[i] * v2[i]) ** -2
+            cross_term = invert(_bucket_exponentiation(ciphertexts, order, starts, nsquare), nsquare)
+            cross_term = mulmod(cross_term, cross_term, nsquare)
+            distance = mulmod(cross_term, (1 + n * norm) % nsquare, nsquare)
+            encrypted_distances.append(paillier.EncryptedNumber(public_key, distance, 0))
+        return encrypted_distances
+
+
+def secure_distance_computation_encoded(client_vector, encoding, public_key, randomizer_pool=None):
+    """secure_distance_computation over a GalleryEncoding. Returns the masked distances in encoding.labels order."""
+    encrypted_client_vector = encrypt_vector(client_vector, public_key, randomizer_pool)
+    encrypted_distances = encoding.encrypted_distances(encrypted_client_vector, public_key)
+    return mask_encrypted_distances(encrypted_distances, public_key, randomizer_pool)
@@ -0,0 +1,258 @@
+# src/segment_store.py
+import mmap
+import os
+import sqlite3
+import threading
+
+from .metrics import logger
+
+
+class SegmentStore:
+    """
+    Template store that keeps labels and ids in SQLite and the ciphertext bytes in an
+    append-only segment file next to the database.
+    Each row of the fingerprint_segments table records where its ciphertext lives in the
+    segment (offset, length). Reads are slices of a memory map of the segment, so scans
+    hand out memoryviews instead of copying every blob into a Python bytes object.
+    Replaced and deleted ciphertexts stay in the segment until compact() is called, which
+    writes a new segment file (segment_path.<generation>) and records it in the database.
+    It offers the reading interface of FingerprintStore used by GalleryReader (page,
+    features_by_id, listeners). It has no enrollment sources, coarse keys, encodings or
+    settings, so sync_directory, pruning, the reducer check of create_and_populate_database
+    and ShardedGallery need a FingerprintStore.
+    """
+
+    def __init__(self, db_name="data/fingerprints.db", segment_path=None, batch_size=500):
+        self.db_name = db_name
+        self.base_path = segment_path or f"{db_name}.segment"
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+        self.listeners = []
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS fingerprint_segments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    label TEXT NOT NULL UNIQUE,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL
+                )
+            ''')
+            # Generation of the segment file the offsets point into, bumped by compact()
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS segment_state (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+            row = self.conn.execute("SELECT value FROM segment_state WHERE name = 'generation'").fetchone()
+        self.generation = row[0] if row else 0
+        self.segment_path = self._generation_path(self.generation)
+        self.segment = open(self.segment_path, "ab+")
+        self._map = None
+
+    def _generation_path(self, generation):
+        """Path of the segment file of a generation; generation 0 is the base path."""
+        return self.base_path if generation == 0 else f"{self.base_path}.{generation}"
+
+    def _view(self):
+        """Return a memoryview of the whole segment, remapping it if the file has grown."""
+        size = os.fstat(self.segment.fileno()).st_size
+        if size == 0:
+            return memoryview(b"")
+        if self._map is None or len(self._map) < size:
+            # Views handed out earlier keep the previous map alive until they are released
+            self._map = mmap.mmap(self.segment.fileno(), size, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def add_listener(self, callback):
+        """Call callback(labels) after every committed insert or delete."""
+        with self.lock:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """Stop notifying a callback registered with add_listener."""
+        with self.lock:
+            self.listeners.remove(callback)
+
+    def _notify(self, labels):
+        """Pass the labels touched by a committed transaction to every listener."""
+        for callback in list(self.listeners):
+            callback(labels)
+
+    def insert_many(self, rows):
+        """
+        Append (label, ciphertext bytes) rows to the segment and index them in one transaction.
+        A label that is already enrolled points to its new ciphertext afterwards.
+        Rows may carry trailing fields of FingerprintStore rows only if they are None.
+        Returns the number of rows written.
+        """
+        count = 0
+        labels = []
+        with self.lock:
+            batch = []
+            for row in rows:
+                if any(field is not None for field in row[2:]):
+                    raise ValueError("SegmentStore stores no coarse keys or encodings; use a FingerprintStore")
+                batch.append((row[0], row[1]))
+                if len(batch) == self.batch_size:
+                    count += self._append(batch)
+                    labels.extend(label for label, _ in batch)
+                    batch = []
+            if batch:
+                count += self._append(batch)
+                labels.extend(label for label, _ in batch)
+            self._notify(labels)
+        return count
+
+    def _append(self, rows):
+        """Write one batch of ciphertexts to the segment, then commit their index rows."""
+        self.segment.seek(0, os.SEEK_END)
+        offset = self.segment.tell()
+        index = []
+        for label, features in rows:
+            index.append((label, offset, len(features)))
+            offset += len(features)
+        self.segment.write(b"".join(bytes(features) for _, features in rows))
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        # A crash before this commit leaves unreferenced bytes, which compaction drops
+        with self.conn:
+            self.conn.executemany('''
+                INSERT INTO fingerprint_segments (label, offset, length)
+                VALUES (?, ?, ?)
+                ON CONFLICT (label) DO UPDATE SET offset = excluded.offset, length = excluded.length
+            ''', index)
+        return len(rows)
+
+    def insert(self, label, features):
+        """Insert or replace the ciphertext of a single label."""
+        return self.insert_many([(label, features)])
+
+    def delete_many(self, labels):
+        """Remove several labels from the index. Their bytes are reclaimed by compact()."""
+        labels = list(labels)
+        with self.lock:
+            with self.conn:
+                before = self.conn.total_changes
+                self.conn.executemany('DELETE FROM fingerprint_segments WHERE label = ?', [(label,) for label in labels])
+                count = self.conn.total_changes - before
+            self._notify(labels)
+        return count
+
+    def get(self, label):
+        """Return a memoryview of the ciphertext stored for a label, or None."""
+        with self.lock:
+            row = self.conn.execute('SELECT offset, length FROM fingerprint_segments WHERE label = ?', (label,)).fetchone()
+            if row is None:
+                return None
+            return self._view()[row[0]:row[0] + row[1]]
+
+    def scan(self):
+        """Yield (id, label, memoryview) for every template, in segment order."""
+        with self.lock:
+            rows = self.conn.execute('SELECT id, label, offset, length FROM fingerprint_segments ORDER BY offset').fetchall()
+            view = self._view()
+        for row_id, label, offset, length in rows:
+            yield row_id, label, view[offset:offset + length]
+
+    def page(self, after_id=0, limit=64):
+        """Return up to limit (id, label, ciphertext size) rows with an id greater than after_id."""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT id, label, length FROM fingerprint_segments WHERE id > ? ORDER BY id LIMIT ?',
+                (after_id, limit)
+            ).fetchall()
+
+    def features_by_id(self, ids):
+        """Return a dict mapping each of the given row ids to a memoryview of its ciphertext."""
+        ids = list(ids)
+        if not ids:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT id, offset, length FROM fingerprint_segments WHERE id IN ({", ".join("?" * len(ids))})', ids
+            ).fetchall()
+            view = self._view()
+        return {row_id: view[offset:offset + length] for row_id, offset, length in rows}
+
+    def labels(self):
+        """Return every enrolled label."""
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT label FROM fingerprint_segments ORDER BY id')]
+
+    def stats(self):
+        """Return the segment size, the bytes still referenced and the reclaimable bytes."""
+        with self.lock:
+            live_bytes = self.conn.execute('SELECT COALESCE(SUM(length), 0) FROM fingerprint_segments').fetchone()[0]
+            segment_bytes = os.fstat(self.segment.fileno()).st_size
+        return {"segment_bytes": segment_bytes, "live_bytes": live_bytes, "dead_bytes": segment_bytes - live_bytes}
+
+    def compact(self):
+        """
+        Rewrite the segment with only the referenced ciphertexts, in id order, into the file
+        of the next generation. The new offsets and generation are committed in one
+        transaction before the store switches files, so a failure at any point leaves the
+        database pointing at a complete segment; the old file is removed afterwards.
+        Returns the number of bytes reclaimed.
+        """
+        with self.lock:
+            before = self.stats()["segment_bytes"]
+            generation = self.generation + 1
+            compacted_path = self._generation_path(generation)
+            rows = self.conn.execute('SELECT id, offset, length FROM fingerprint_segments ORDER BY id').fetchall()
+            view = self._view()
+            index = []
+            try:
+                with open(compacted_path, "wb") as compacted:
+                    for row_id, offset, length in rows:
+                        index.append((compacted.tell(), row_id))
+                        compacted.write(view[offset:offset + length])
+                    compacted.flush()
+                    os.fsync(compacted.fileno())
+                view.release()
+                with self.conn:
+                    self.conn.executemany('UPDATE fingerprint_segments SET offset = ? WHERE id = ?', index)
+                    self.conn.execute('''
+                        INSERT INTO segment_state (name, value) VALUES ('generation', ?)
+                        ON CONFLICT (name) DO UPDATE SET value = excluded.value
+                    ''', (generation,))
+            except BaseException:
+                view.release()
+                if os.path.exists(compacted_path):
+                    os.remove(compacted_path)
+                raise
+            old_path = self.segment_path
+            self.segment.close()
+            self._close_map()
+            self.generation = generation
+            self.segment_path = compacted_path
+            self.segment = open(self.segment_path, "ab+")
+            os.remove(old_path)
+            after = os.fstat(self.segment.fileno()).st_size
+        logger.info("Compacted %s: reclaimed %d bytes.", self.segment_path, before - after)
+        return before - after
+
+    def _close_map(self):
+        """Unmap the segment; a map still exported by memoryviews handed out earlier is left to them."""
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
+
+    def close(self):
+        """Close the segment file and the database connection."""
+        with self.lock:
+            self._close_map()
+            self.segment.close()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
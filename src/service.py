@@ -0,0 +1,455 @@
+# src/service.py
+"""
+Long-running verification service.
+
+Keeps the gallery, circuits and keys loaded and answers identification requests over
+HTTP on a local port. Concurrent requests are grouped into micro-batches: the first
+request of a batch waits at most batch_window seconds for others, then the whole batch is
+preprocessed, extracted and matched in one call on an executor thread.
+
+    python -m src.service --gallery data/dataset_FVC2000_DB4_B/dataset/train_data --port 8080
+
+Endpoints:
+    POST /identify   {"image": <base64 image file>} or {"features": [640 floats]}
+                     or {"quantized": [dims ints in 0..max_value]}, optional "k"
+    GET  /metrics    Prometheus text (src.metrics)
+    GET  /health     queue depth and batch statistics
+"""
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from .database import quantize_features
+from .fhe_matching import (
+    get_distance_circuit,
+    encrypt_probe,
+    encrypt_gallery,
+    fhe_gallery_distances,
+    decrypt_gallery_distances,
+    decision_layout,
+    get_decision_circuit,
+    encrypt_decision_probe,
+    prepare_decision_gallery,
+    fhe_gallery_decisions,
+    decrypt_best_match,
+)
+from .index import QuantizedIndex
+from .metrics import logger, span, increment, observe, prometheus_text, enable_metrics
+from .preprocessing import preprocess_image, load_and_preprocess_image, extract_fingercode_features_batch
+from .quantization import Quantizer
+from .reduction import DimensionReducer
+
+
+# Largest request body accepted, well above a base64-encoded fingerprint image
+DEFAULT_MAX_BODY_SIZE = 4 << 20
+
+
+class Overloaded(Exception):
+    """Raised when a request is refused by admission control."""
+
+
+class BadRequest(Exception):
+    """Raised for a malformed request (HTTP 400); any other error is answered with 500."""
+
+
+class PayloadTooLarge(Exception):
+    """Raised when a request announces a body larger than the service accepts (HTTP 413)."""
+
+
+class IndexMatcher:
+    """Match quantized probes against a plaintext QuantizedIndex (trusted-zone deployments)."""
+
+    def __init__(self, index):
+        self.index = index
+
+    def match_batch(self, probes, k):
+        return self.index.search_batch(probes, k)
+
+
+class FHEMatcher:
+    """
+    Match quantized probes with the batched Concrete distance circuit (src.fhe_matching).
+    The service holds the client keys here, so it encrypts each probe, runs the circuit
+    over the prepared gallery chunks and decrypts the distances itself.
+    """
+
+    def __init__(self, labels, gallery, chunk_size=64, max_value=127):
+        self.labels = list(labels)
+        self.circuit = get_distance_circuit(chunk_size=chunk_size, dims=gallery.shape[1], max_value=max_value)
+        self.chunks = encrypt_gallery(self.circuit, gallery, chunk_size)
+
+    def match_batch(self, probes, k):
+        results = []
+        for probe in probes:
+            encrypted_probe = encrypt_probe(self.circuit, probe)
+            encrypted_distances = fhe_gallery_distances(self.circuit, encrypted_probe, self.chunks)
+            distances = decrypt_gallery_distances(self.circuit, encrypted_distances, len(self.labels))
+            # The circuit leaves out ||x||^2, which does not change the ranking
+            distances = distances + int(np.dot(probe.astype(np.int64), probe))
+            nearest = np.argsort(distances, kind="stable")[:k]
+            results.append([(self.labels[row], int(distances[row])) for row in nearest])
+        return results
+
+
+class FHEArgminMatcher:
+    """
+    Match quantized probes with the argmin decision module (src.fhe_matching): the nearest
+    template of the whole gallery is selected under encryption, so only one result is
+    decrypted per probe. Returns the single best match. Needs reduced, low-bit-width
+    templates (e.g. 32 dims at 2 bits, see decision_layout).
+    """
+
+    def __init__(self, labels, gallery, chunk_size=8, max_value=3):
+        self.labels = list(labels)
+        chunks = -(-len(self.labels) // chunk_size)
+        self.layout = decision_layout("argmin", chunk_size, gallery.shape[1], max_value, max_chunks=max(128, chunks))
+        self.circuit = get_decision_circuit(self.layout)
+        self.chunks = prepare_decision_gallery(self.circuit, gallery, self.layout)
+
+    def match_batch(self, probes, k):
+        results = []
+        for probe in probes:
+            encrypted_probe = encrypt_decision_probe(self.circuit, probe)
+            encrypted_result = fhe_gallery_decisions(self.circuit, encrypted_probe, self.chunks)
+            row, distance = decrypt_best_match(self.circuit, encrypted_result, self.layout)
+            results.append([(self.labels[row], distance)])
+        return results
+
+
+class VerificationService:
+    """
+    Micro-batching front of a matcher.
+    At most max_pending requests are queued or in flight; more are refused with Overloaded
+    (HTTP 503) instead of letting latency grow without bound.
+    Features are reduced and quantized with reducer and quantizer (the ones the gallery was
+    enrolled with), or with the per-vector 7-bit scale of quantize_features without them;
+    a reducer always needs its quantizer.
+    """
+
+    def __init__(self, matcher, batch_window=0.005, max_batch_size=32, max_pending=256, workers=1, default_k=5,
+                 quantizer=None, reducer=None):
+        self.matcher = matcher
+        self.quantizer = quantizer
+        self.reducer = reducer
+        self.max_value = quantizer.max_value if quantizer else 127
+        self.dims = reducer.dims if reducer else 640
+        self.input_dims = reducer.input_dims if reducer else 640
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.default_k = default_k
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.pending = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.queue = None
+        self.batcher = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def identify(self, request):
+        """Queue a request dict and wait for its matches."""
+        if self.pending >= self.max_pending:
+            increment("requests_rejected")
+            raise Overloaded(f"{self.pending} requests pending")
+        self.pending += 1
+        future = asyncio.get_running_loop().create_future()
+        try:
+            await self.queue.put((request, future, time.perf_counter()))
+            return await future
+        finally:
+            self.pending -= 1
+
+    async def _batch_loop(self):
+        """Collect requests into batches and hand them to the executor."""
+        loop = asyncio.get_running_loop()
+        # One batch per executor thread may run while the next one is being collected
+        slots = asyncio.Semaphore(self.workers)
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await slots.acquire()
+            task = loop.run_in_executor(self.executor, self._process_batch, [request for request, _, _ in batch])
+            task.add_done_callback(lambda task, batch=batch: self._finish_batch(task, batch, slots))
+
+    def _finish_batch(self, task, batch, slots):
+        """Resolve the futures of a finished batch."""
+        slots.release()
+        self.batches += 1
+        self.batched_requests += len(batch)
+        try:
+            results = task.result()
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future, queued), result in zip(batch, results):
+            observe("request", time.perf_counter() - queued)
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _parse_request(self, request):
+        """
+        Validate one request. Returns (preprocessed image or None, quantized probe or None, k);
+        raises BadRequest for a malformed one.
+        """
+        if not isinstance(request, dict):
+            raise BadRequest("Request must be a JSON object")
+        try:
+            k = int(request.get("k", self.default_k))
+        except (TypeError, ValueError):
+            raise BadRequest(f"k must be a positive integer, got {request['k']!r}") from None
+        if k < 1:
+            raise BadRequest(f"k must be a positive integer, got {k}")
+        if "image" in request:
+            try:
+                data = np.frombuffer(base64.b64decode(request["image"], validate=True), dtype=np.uint8)
+            except (TypeError, ValueError):
+                raise BadRequest("image must be a base64 image file") from None
+            image = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE) if data.size else None
+            if image is None:
+                raise BadRequest("Could not decode image")
+            return preprocess_image(image), None, k
+        if "features" in request:
+            try:
+                features = np.asarray(request["features"], dtype=np.float64)
+            except (TypeError, ValueError):
+                features = None
+            if features is None or features.shape != (self.input_dims,) or not np.isfinite(features).all():
+                raise BadRequest(f"features must hold {self.input_dims} finite numbers")
+            return None, quantize_features(features, quantizer=self.quantizer, reducer=self.reducer), k
+        if "quantized" in request:
+            try:
+                vector = np.asarray(request["quantized"], dtype=np.int64)
+            except (TypeError, ValueError, OverflowError):
+                vector = None
+            if vector is None or vector.shape != (self.dims,) or vector.min() < 0 or vector.max() > self.max_value:
+                raise BadRequest(f"quantized must hold {self.dims} integers in 0..{self.max_value}")
+            return None, vector.astype(np.uint8), k
+        raise BadRequest("Request needs image, features or quantized")
+
+    def _process_batch(self, requests):
+        """Decode, extract, quantize and match a batch (executor thread). Returns one result or error per request."""
+        with span("service_batch"):
+            results = [None] * len(requests)
+            probes = [None] * len(requests)
+            ks = [self.default_k] * len(requests)
+            images, image_slots = [], []
+            for slot, request in enumerate(requests):
+                try:
+                    image, probes[slot], ks[slot] = self._parse_request(request)
+                    if image is not None:
+                        images.append(image)
+                        image_slots.append(slot)
+                except Exception as e:
+                    results[slot] = e
+            if images:
+                try:
+                    quantized = quantize_features(extract_fingercode_features_batch(images),
+                                                  quantizer=self.quantizer, reducer=self.reducer)
+                    for slot, vector in zip(image_slots, quantized):
+                        probes[slot] = vector
+                except Exception as e:
+                    for slot in image_slots:
+                        results[slot] = e
+
+            ready = [slot for slot in range(len(requests)) if probes[slot] is not None]
+            if ready:
+                try:
+                    matches = self.matcher.match_batch(np.stack([probes[slot] for slot in ready]),
+                                                       max(ks[slot] for slot in ready))
+                except Exception as e:
+                    matches = [e] * len(ready)
+                for slot, match in zip(ready, matches):
+                    if isinstance(match, Exception):
+                        results[slot] = match
+                    else:
+                        results[slot] = [{"label": label, "distance": distance} for label, distance in match[:ks[slot]]]
+            increment("requests_served", len(requests))
+            return results
+
+    def health(self):
+        return {
+            "pending": self.pending,
+            "batches": self.batches,
+            "mean_batch_size": self.batched_requests / self.batches if self.batches else None,
+        }
+
+
+async def _read_request(reader, max_body_size=DEFAULT_MAX_BODY_SIZE):
+    """
+    Read one HTTP/1.1 request. Returns (method, path, headers, body) or None at end of stream.
+    A Content-Length above max_body_size raises PayloadTooLarge before the body is read.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise BadRequest("Malformed request line")
+    method, path, _ = parts
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise BadRequest("Malformed Content-Length") from None
+    if length < 0:
+        raise BadRequest("Malformed Content-Length")
+    if length > max_body_size:
+        raise PayloadTooLarge(f"Body of {length} bytes exceeds the limit of {max_body_size}")
+    body = await reader.readexactly(length)
+    return method, path, headers, body
+
+
+def _response(status, body, content_type="application/json"):
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+    if not isinstance(body, bytes):
+        body = (json.dumps(body) if content_type == "application/json" else body).encode()
+    head = f"HTTP/1.1 {status} {reasons.get(status, 'Error')}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+    return head.encode("latin-1") + body
+
+
+async def _handle_connection(service, reader, writer, max_body_size=DEFAULT_MAX_BODY_SIZE):
+    """Serve HTTP requests of one keep-alive connection."""
+    try:
+        while True:
+            try:
+                request = await _read_request(reader, max_body_size)
+            except (BadRequest, PayloadTooLarge) as e:
+                # The rest of the stream cannot be framed, so the connection is closed
+                writer.write(_response(413 if isinstance(e, PayloadTooLarge) else 400, {"error": str(e)}))
+                await writer.drain()
+                break
+            if request is None:
+                break
+            method, path, headers, body = request
+            if method == "POST" and path == "/identify":
+                try:
+                    try:
+                        request = json.loads(body)
+                    except ValueError as e:
+                        raise BadRequest(f"Invalid JSON: {e}") from None
+                    matches = await service.identify(request)
+                    response = _response(200, {"matches": matches})
+                except BadRequest as e:
+                    response = _response(400, {"error": str(e)})
+                except Overloaded as e:
+                    response = _response(503, {"error": str(e)})
+                except Exception as e:
+                    logger.exception("Request failed")
+                    response = _response(500, {"error": str(e)})
+            elif method == "GET" and path == "/metrics":
+                response = _response(200, prometheus_text(), "text/plain; version=0.0.4")
+            elif method == "GET" and path == "/health":
+                response = _response(200, service.health())
+            else:
+                response = _response(404, {"error": f"No route for {method} {path}"})
+            writer.write(response)
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service, host="127.0.0.1", port=8080, max_body_size=DEFAULT_MAX_BODY_SIZE):
+    """Run the HTTP front end of a VerificationService until cancelled."""
+    await service.start()
+    server = await asyncio.start_server(lambda r, w: _handle_connection(service, r, w, max_body_size), host, port)
+    logger.info("Verification service listening on %s:%s", host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def load_gallery(gallery_dir, batch_size=32, quantizer=None, reducer=None):
+    """Extract and quantize every image of a directory. Returns (labels, (N, dims) uint8 array)."""
+    filenames = sorted(f for f in os.listdir(gallery_dir) if f.endswith((".bmp", ".jpg", ".png")))
+    labels = [os.path.splitext(filename)[0] for filename in filenames]
+    vectors = []
+    for start in range(0, len(filenames), batch_size):
+        images = [load_and_preprocess_image(os.path.join(gallery_dir, f)) for f in filenames[start:start + batch_size]]
+        features = extract_fingercode_features_batch(images)
+        vectors.append(quantize_features(features, quantizer=quantizer, reducer=reducer))
+    return labels, np.concatenate(vectors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprint verification service")
+    parser.add_argument("--gallery", required=True, help="directory of gallery images")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--matcher", choices=("index", "fhe", "fhe-argmin"), default="index")
+    parser.add_argument("--batch-window", type=float, default=0.005, help="seconds to wait for a batch to fill")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-pending", type=int, default=256, help="requests queued before answering 503")
+    parser.add_argument("--workers", type=int, default=1, help="executor threads running batches")
+    parser.add_argument("--max-body-size", type=int, default=DEFAULT_MAX_BODY_SIZE,
+                        help="largest request body in bytes, larger ones are answered with 413")
+    parser.add_argument("--quantizer", help="quantizer saved with the gallery database (src.quantization)")
+    parser.add_argument("--reducer", help="reducer saved with the gallery database (src.reduction)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    enable_metrics()
+    quantizer = Quantizer.load(args.quantizer) if args.quantizer else None
+    reducer = DimensionReducer.load(args.reducer) if args.reducer else None
+    if reducer is not None and quantizer is None:
+        raise ValueError("--reducer needs the --quantizer fitted on reduced features (per_dimension=False)")
+    max_value = quantizer.max_value if quantizer else 127
+    labels, gallery = load_gallery(args.gallery, quantizer=quantizer, reducer=reducer)
+    if args.matcher == "fhe":
+        matcher = FHEMatcher(labels, gallery, max_value=max_value)
+    elif args.matcher == "fhe-argmin":
+        matcher = FHEArgminMatcher(labels, gallery, max_value=max_value)
+    else:
+        index = QuantizedIndex(dims=gallery.shape[1], max_value=max_value, capacity=max(1, len(labels)))
+        index.add_many(labels, gallery)
+        matcher = IndexMatcher(index)
+    logger.info("Loaded %d gallery templates", len(labels))
+    service = VerificationService(matcher, args.batch_window, args.max_batch_size, args.max_pending, args.workers,
+                                  quantizer=quantizer, reducer=reducer)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.max_body_size))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+# src/sharding.py
+"""
+Gallery partitioned into shards, each served by its own worker process.
+
+Every label belongs to one shard, chosen by rendezvous hashing: the shard with the highest
+hash of (shard, label). Adding a shard only moves the labels that now rank it first (about
+1/N of them) and removing one only moves its own labels, so rebalance() copies few rows.
+A shard is a FingerprintStore file of its own (shard_path) and a single-process executor
+that owns its connection and keeps the decrypted templates of the shard in a
+QuantizedIndex. Searches are scattered to every shard and their partial results gathered
+and merged here; on one machine the worker processes stand in for nodes.
+
+Matching against the decrypted templates is intentional. The stored templates are Concrete
+ciphertexts of the encryption circuit, whose keys no matching circuit shares, and the
+Paillier kernel (compute_encrypted_squared_distance) takes clear templates, as the unsharded
+secure_distance_computation does. The workers therefore hold the encryption circuit's keys,
+like any process that decrypts the database; only the probe stays encrypted, and only masked
+distances leave a shard in secure_distance_computation. Run the workers in the trust zone
+that owns those keys.
+"""
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from phe import paillier
+
+from .circuit_cache import CachedCircuit
+from .database import FingerprintStore, get_encryption_circuit
+from .index import QuantizedIndex
+from .metrics import increment, span
+from .secure_computation import compute_encrypted_squared_distance, mask_encrypted_distances
+
+
+def _shard_weight(shard, label):
+    """Rendezvous hash of a (shard, label) pair."""
+    digest = hashlib.blake2b(f"{shard}/{label}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def shard_for_label(label, shards):
+    """Return the shard a label belongs to among the given shard names."""
+    return max(shards, key=lambda shard: _shard_weight(shard, label))
+
+
+def shard_path(db_name, shard):
+    """Path of the database file of a shard, next to db_name."""
+    root, extension = os.path.splitext(db_name)
+    return f"{root}.{shard}{extension or '.db'}"
+
+
+# Store, circuit and templates of a shard worker process, set up once by _init_shard
+_shard_name = None
+_shard_store = None
+_shard_circuit = None
+_shard_index = None
+_shard_public_keys = {}
+
+
+def _decrypt_templates(blobs):
+    """Decrypt serialized Concrete templates to quantized vectors."""
+    return [_shard_circuit.decrypt(_shard_circuit.deserialize(blob)) for blob in blobs]
+
+
+def _init_shard(name, db_path, circuit_path, dims, max_value, page_size=256):
+    """Open the shard's database and load its decrypted templates once per worker process."""
+    global _shard_name, _shard_store, _shard_circuit, _shard_index
+    _shard_name = name
+    _shard_store = FingerprintStore(db_path)
+    _shard_circuit = CachedCircuit.load(circuit_path)
+    _shard_index = QuantizedIndex(dims=dims, max_value=max_value)
+    rows = _shard_store.page(0, page_size)
+    while rows:
+        blobs = _shard_store.features_by_id(row[0] for row in rows)
+        labels = [label for row_id, label, _ in rows if row_id in blobs]
+        if labels:
+            _shard_index.add_many(labels, _decrypt_templates(blobs[row_id] for row_id, _, _ in rows if row_id in blobs))
+        rows = _shard_store.page(rows[-1][0], page_size)
+
+
+def _shard_insert(rows):
+    """Insert or replace (label, encrypted features) rows in the shard. Returns the number written."""
+    labels = [row[0] for row in rows]
+    vectors = _decrypt_templates(row[1] for row in rows)
+    count = _shard_store.insert_many(rows)
+    _shard_index.add_many(labels, vectors)
+    return count
+
+
+def _shard_delete(labels):
+    """Delete labels from the shard. Returns the number removed."""
+    count = _shard_store.delete_many(labels)
+    _shard_index.remove_many(labels)
+    return count
+
+
+def _shard_moving_rows(shards):
+    """Return the (label, encrypted features) rows of the shard that belong to another of shards."""
+    labels = [label for label in _shard_store.labels() if shard_for_label(label, shards) != _shard_name]
+    return [(label, _shard_store.get(label)) for label in labels]
+
+
+def _shard_size():
+    return len(_shard_index)
+
+
+def _shard_search(probes, k):
+    """Plaintext k nearest templates of the shard for each probe."""
+    return _shard_index.search_batch(probes, k)
+
+
+def _shard_secure_distances(n, ciphertexts, exponents):
+    """
+    Masked encrypted distances between a Paillier-encrypted probe, sent as raw ciphertexts,
+    and every template of the shard. Returns the labels and (ciphertext, exponent, mask) triples.
+    """
+    public_key = _shard_public_keys.get(n)
+    if public_key is None:
+        public_key = _shard_public_keys[n] = paillier.PaillierPublicKey(n)
+    encrypted_probe = [paillier.EncryptedNumber(public_key, ciphertext, exponent)
+                       for ciphertext, exponent in zip(ciphertexts, exponents)]
+    with _shard_index.lock:
+        labels = list(_shard_index.labels)
+        vectors = _shard_index.vectors[:len(labels)].copy()
+    encrypted_distances = [compute_encrypted_squared_distance(encrypted_probe, vector, public_key) for vector in vectors]
+    masked = mask_encrypted_distances(encrypted_distances, public_key)
+    return labels, [(distance.ciphertext(False), distance.exponent, mask) for distance, mask in masked]
+
+
+class ShardedGallery:
+    """
+    Template store partitioned into shards by label (see the module docstring).
+    shards is a number of shards or a list of shard names; the shard files live next to
+    db_name and keep their rows across runs. Opening a gallery with a different set of
+    shards than it was filled with leaves labels on the wrong shard until rebalance().
+    Workers load the templates with the encryption circuit's keys from its cache entry
+    (see get_encryption_circuit), so circuit, dims and max_value must match enrollment.
+    """
+
+    def __init__(self, db_name="data/fingerprints.db", shards=4, circuit=None, dims=640, max_value=127):
+        self.db_name = db_name
+        self.dims = dims
+        self.max_value = max_value
+        self.circuit = circuit or get_encryption_circuit(max_value=max_value, dims=dims)
+        self.workers = {}  # shard name -> single-process executor
+        names = [f"shard-{i}" for i in range(shards)] if isinstance(shards, int) else list(shards)
+        if not names:
+            raise ValueError("A sharded gallery needs at least one shard")
+        for name in names:
+            self._start(name)
+
+    def _start(self, name):
+        """Start the worker process of a shard."""
+        if name in self.workers:
+            raise ValueError(f"Shard {name} already exists")
+        self.workers[name] = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_shard,
+            initargs=(name, shard_path(self.db_name, name), self.circuit.path, self.dims, self.max_value),
+        )
+
+    @property
+    def shards(self):
+        return list(self.workers)
+
+    def _scatter(self, function, *args):
+        """Run function(*args) on every shard at once. Returns {shard: result}."""
+        jobs = {name: executor.submit(function, *args) for name, executor in self.workers.items()}
+        return {name: job.result() for name, job in jobs.items()}
+
+    def _route(self, items, label_of=lambda item: item):
+        """Group items by the shard of their label."""
+        groups = {}
+        for item in items:
+            groups.setdefault(shard_for_label(label_of(item), self.shards), []).append(item)
+        return groups
+
+    def insert_many(self, rows):
+        """Insert or replace (label, encrypted features) rows, each on its shard. Returns the number written."""
+        jobs = [self.workers[name].submit(_shard_insert, group)
+                for name, group in self._route(rows, lambda row: row[0]).items()]
+        return sum(job.result() for job in jobs)
+
+    def delete_many(self, labels):
+        """
+        Delete labels from every shard, so labels left on their old shard by a change of shards
+        are removed before rebalance() too. Returns the number of rows removed.
+        """
+        return sum(self._scatter(_shard_delete, list(labels)).values())
+
+    def import_store(self, store, page_size=256):
+        """Copy every template of an unsharded FingerprintStore into the shards. Returns the number copied."""
+        count = 0
+        rows = store.page(0, page_size)
+        while rows:
+            blobs = store.features_by_id(row[0] for row in rows)
+            count += self.insert_many([(label, blobs[row_id]) for row_id, label, _ in rows if row_id in blobs])
+            rows = store.page(rows[-1][0], page_size)
+        return count
+
+    def sizes(self):
+        """Return the number of templates on every shard."""
+        return self._scatter(_shard_size)
+
+    def __len__(self):
+        return sum(self.sizes().values())
+
+    def search_batch(self, probes, k=5):
+        """
+        Plaintext k nearest labels of each quantized probe, as QuantizedIndex.search_batch
+        (trusted-zone deployments). Every shard returns its own top k, which are merged.
+        """
+        probes = np.asarray(probes)
+        with span("sharded_search"):
+            partial = self._scatter(_shard_search, probes, k)
+        return [
+            list(itertools.islice(heapq.merge(*(partial[name][i] for name in self.shards), key=lambda match: match[1]), k))
+            for i in range(len(probes))
+        ]
+
+    def secure_distance_computation(self, encrypted_probe, public_key):
+        """
+        Sharded secure_distance_computation for a probe encrypted with encrypt_vector.
+        The raw ciphertexts are scattered to every shard, and each returns the masked
+        encrypted distances of its templates. Returns the labels and their masked distances
+        in the same order, ready for decrypt_and_unmask_distances_batch on the client.
+        """
+        ciphertexts = [value.ciphertext(False) for value in encrypted_probe]
+        exponents = [value.exponent for value in encrypted_probe]
+        with span("sharded_secure_distances"):
+            partial = self._scatter(_shard_secure_distances, public_key.n, ciphertexts, exponents)
+        labels, masked_encrypted_distances = [], []
+        for name in self.shards:
+            shard_labels, values = partial[name]
+            labels.extend(shard_labels)
+            masked_encrypted_distances.extend((paillier.EncryptedNumber(public_key, ciphertext, exponent), mask)
+                                              for ciphertext, exponent, mask in values)
+        return labels, masked_encrypted_distances
+
+    def rebalance(self):
+        """
+        Move every label to the shard it belongs to under the current set of shards.
+        Rows are copied to their new shard before they are deleted from the old one, so an
+        interrupted rebalance leaves duplicates that the next one removes, never a lost row.
+        Returns the number of moved templates.
+        """
+        moved = 0
+        for name, rows in self._scatter(_shard_moving_rows, self.shards).items():
+            if not rows:
+                continue
+            self.insert_many(rows)
+            self.workers[name].submit(_shard_delete, [label for label, _ in rows]).result()
+            moved += len(rows)
+        increment("shard_rows_moved", moved)
+        return moved
+
+    def add_shard(self, name=None):
+        """Start a new shard and move its labels to it. Returns the number of moved templates."""
+        if name is None:
+            name = next(f"shard-{i}" for i in itertools.count(len(self.workers)) if f"shard-{i}" not in self.workers)
+        self._start(name)
+        return self.rebalance()
+
+    def remove_shard(self, name):
+        """Move the labels of a shard to the other shards and stop its worker. Returns the number moved."""
+        if len(self.workers) == 1:
+            raise ValueError("Cannot remove the last shard")
+        executor = self.workers.pop(name)
+        try:
+            rows = executor.submit(_shard_moving_rows, self.shards).result()
+            self.insert_many(rows)
+            executor.submit(_shard_delete, [label for label, _ in rows]).result()
+        except Exception:
+            self.workers[name] = executor
+            raise
+        executor.shutdown()
+        increment("shard_rows_moved", len(rows))
+        return len(rows)
+
+    def close(self):
+        """Stop every worker process."""
+        for executor in self.workers.values():
+            executor.shutdown()
+        self.workers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()